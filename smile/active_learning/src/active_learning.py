@@ -4,33 +4,123 @@ import numpy as np
 from progress import ProgressMonitor
 
 class ActiveLearner(object):
+    """
+    If the classifier can be refit incrementally (with
+    partial_fit) and can make predictions from kernels
+    with its training bags (see SetSVM, with incremental
+    set), the kernels of the pool and test bags with the
+    labeled bags are kept across queries, and only
+    extended by a column for each newly labeled bag
 
-    def __init__(self, classifier, queries, verbose=True):
+    With batch_size > 1, up to that many bags are labeled
+    before the classifier is refit; the predictions after
+    the other queries of a batch repeat the previous ones
+
+    Test predictions are only made after the queries listed
+    in checkpoints (by default, after every query)
+    """
+
+    def __init__(self, classifier, queries, verbose=True, batch_size=1,
+                 checkpoints=None):
         self.classifier = classifier
         self.queries = queries
         self.verbose = verbose
+        self.batch_size = batch_size
+        if checkpoints is None:
+            self.checkpoints = range(queries + 1)
+        else:
+            self.checkpoints = sorted(set(q for q in checkpoints
+                                          if 0 <= q <= queries))
+        self.pool_kernel = None
+        self.test_kernel = None
 
     def learn(self, X_labeled, y_labeled, X_pool, y_pool, X_test):
+        """
+        @return : a list of the predictions on the test bags
+                  after each of the queries in checkpoints
+        """
+        cached = (hasattr(self.classifier, 'partial_fit')
+                  and hasattr(self.classifier, 'train_kernel')
+                  and getattr(self.classifier, 'incremental', True))
+        checkpoints = set(self.checkpoints)
+        self.test_kernel = None
+
         # Initial Predictions
         self.classifier.fit(X_labeled, y_labeled)
-        predictions = [self.classifier.decision_function(X_test)]
+        if cached:
+            self.pool_kernel = self.classifier.train_kernel(X_pool)
+        predictions = []
+        current = None
+        if 0 in checkpoints:
+            current = self.test_predictions(X_labeled, X_test, cached)
+            predictions.append(current)
 
         if self.verbose:
             progress = ProgressMonitor(total=self.queries, msg='Active Learning')
-        for q in range(self.queries):
+        q = 0
+        while q < self.queries:
             if len(X_pool) <= 0:
                 if self.verbose: print 'Warning: skipping query %d...' % q
-                predictions.append(predictions[-1])
+                q += 1
+                if q in checkpoints:
+                    if current is None:
+                        current = self.test_predictions(X_labeled, X_test,
+                                                        cached)
+                    predictions.append(current)
+                if self.verbose: progress.increment()
+                continue
+
+            batch = min(self.batch_size, self.queries - q, len(X_pool))
+            selected = self.select_batch(X_pool, batch)
+            X_new = [X_pool[i] for i in selected]
+            y_new = [y_pool[i] for i in selected]
+            for i in sorted(selected, reverse=True):
+                X_pool.pop(i)
+                y_pool.pop(i)
+
+            # Queries within the batch do not refit
+            within = [c for c in range(q + 1, q + batch) if c in checkpoints]
+            if within and current is None:
+                current = self.test_predictions(X_labeled, X_test, cached)
+            predictions.extend([current]*len(within))
+
+            X_labeled.extend(X_new)
+            y_labeled.extend(y_new)
+            if cached:
+                # Only adds the kernel of the new bags
+                self.pool_kernel = np.delete(self.pool_kernel,
+                                             selected, axis=0)
+                self.classifier.partial_fit(X_new, y_new)
+                if len(X_pool) > 0:
+                    self.pool_kernel = np.hstack([self.pool_kernel,
+                        self.classifier.kernel(X_pool, X_new)])
             else:
-                next_labeled = self.select(X_pool)
-                X_labeled.append(X_pool.pop(next_labeled))
-                y_labeled.append(y_pool.pop(next_labeled))
                 self.classifier.fit(X_labeled, y_labeled)
-                predictions.append(self.classifier.decision_function(X_test))
-            if self.verbose: progress.increment()
+            current = None
+            q += batch
+            if q in checkpoints:
+                current = self.test_predictions(X_labeled, X_test, cached)
+                predictions.append(current)
+            if self.verbose: progress.increment(batch)
 
         return predictions
 
+    def test_predictions(self, X_labeled, X_test, cached):
+        """
+        Decision function of the classifier on the test bags; the
+        kept kernel of the test bags is only extended by the columns
+        of the bags labeled since the last checkpoint
+        """
+        if not cached:
+            return self.classifier.decision_function(X_test)
+        if self.test_kernel is None:
+            self.test_kernel = self.classifier.train_kernel(X_test)
+        elif self.test_kernel.shape[1] < len(X_labeled):
+            X_new = X_labeled[self.test_kernel.shape[1]:]
+            self.test_kernel = np.hstack([self.test_kernel,
+                self.classifier.kernel(X_test, X_new)])
+        return self.classifier.decision_from_kernel(self.test_kernel)
+
     def select(self, pool):
         """
         Selects the instance from the pool whose labeled will be queried.
@@ -38,16 +128,74 @@ class ActiveLearner(object):
         """
         pass
 
+    def select_batch(self, pool, k):
+        """
+        Selects k (distinct) instances from the pool whose labels will be
+        queried before the classifier is refit; by default, select is
+        called k times, and each selected instance is removed from the
+        pool (and from the kept kernel of the pool) before the next call.
+        @return : a list of the indices of those instances
+        """
+        pool = list(pool)
+        indices = range(len(pool))
+        pool_kernel = self.pool_kernel
+        selected = []
+        try:
+            for _ in range(k):
+                i = self.select(pool)
+                selected.append(indices.pop(i))
+                pool.pop(i)
+                if self.pool_kernel is not None:
+                    self.pool_kernel = np.delete(self.pool_kernel, i, axis=0)
+        finally:
+            self.pool_kernel = pool_kernel
+        return selected
+
+    def pool_decision_function(self, pool):
+        """
+        Decision function of the classifier on the pool
+        (from the kept kernel of the pool, if any)
+        """
+        if self.pool_kernel is not None:
+            return self.classifier.decision_from_kernel(self.pool_kernel)
+        return self.classifier.decision_function(pool)
+
 class SVMActiveLearner(ActiveLearner):
+    """
+    Queries the bags nearest to the decision boundary; in
+    a batch, each further bag's distance is penalized by
+    diversity times its largest similarity to the bags
+    already selected, as measured by the cosine between
+    their rows of the kernel with the labeled bags (which
+    needs the kept kernel of the pool)
+    """
 
     def __init__(self, *args, **kwargs):
         self.selection_technique = kwargs.pop('selection_technique', 'nearest')
+        self.diversity = kwargs.pop('diversity', 0.0)
         super(SVMActiveLearner, self).__init__(*args, **kwargs)
 
     def select(self, pool):
-        if self.selection_technique == 'nearest':
-            distances = np.abs(self.classifier.decision_function(pool))
-            return np.argmin(distances)
-        else:
+        return self.select_batch(pool, 1)[0]
+
+    def select_batch(self, pool, k):
+        if self.selection_technique != 'nearest':
             raise Exception('Unsupported selection technique: "%s"'
                             % self.selection_technique)
+
+        distances = np.abs(self.pool_decision_function(pool))
+        if self.diversity <= 0 or self.pool_kernel is None or k == 1:
+            return list(np.argsort(distances, kind='mergesort')[:k])
+
+        rows = self.pool_kernel
+        lengths = np.sqrt(np.sum(np.square(rows), axis=1))
+        rows = rows / np.maximum(lengths, 1e-12).reshape((-1, 1))
+        penalty = np.zeros(len(pool))
+        selected = []
+        for _ in range(k):
+            scores = distances + self.diversity*penalty
+            scores[selected] = np.inf
+            next_selected = np.argmin(scores)
+            selected.append(next_selected)
+            penalty = np.maximum(penalty, np.dot(rows, rows[next_selected]))
+        return selected
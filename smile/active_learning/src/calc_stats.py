@@ -29,11 +29,13 @@ def calc_auc_score(key, task_list, y_dict):
         for q, p in preds.items():
             predictions[q].update(p)
 
+    queries = []
     aucs = []
     for q, p in sorted(predictions.items()):
+        queries.append(q)
         aucs.append(auc_score(*true_and_pred(y_dict, p)))
 
-    return np.array(aucs)
+    return queries, np.array(aucs)
 
 def main(configfile, folddir, resultsdir, outputfile):
     with open(configfile, 'r') as f:
@@ -88,14 +90,23 @@ def main(configfile, folddir, resultsdir, outputfile):
                 y_dict[bid] |= bool(yi)
 
             aucs = []
+            checkpoints = set()
             for rep, task_list in sorted(reps.items()):
                 if all(task.finished for task in task_list):
-                    aucs.append(calc_auc_score(key, task_list, y_dict))
+                    queries, rep_aucs = calc_auc_score(key, task_list, y_dict)
+                    checkpoints.add(tuple(queries))
+                    aucs.append(rep_aucs)
                 else:
                     break
             if len(aucs) != len(reps):
                 print 'Skipping %s (incomplete)...' % str(key)
                 continue
+            if len(checkpoints) != 1:
+                print 'Skipping %s (different checkpoints)...' % str(key)
+                continue
+            queries, = checkpoints
+            if list(queries) != range(key[-1] + 1):
+                print 'Checkpoints of %s: %s' % (str(key), list(queries))
             aucs = np.vstack(aucs)
             avg_aucs = np.average(aucs, axis=0)
             line = ','.join(map(str, key) + map(str, avg_aucs.flat))
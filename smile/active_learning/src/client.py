@@ -75,15 +75,48 @@ def do_submit(host, port, task, retval):
     finally:
         connection.close()
 
-def client_loop(target, host, port=PORT, blacklist=None):
-    def wrapper(task, callback):
+def client_loop(target, host, port=PORT, blacklist=None, group_target=None):
+    """
+    The server can hand out a group of tasks at once (see
+    server.py), which are run by group_target (or one after
+    the other by target); each result is submitted under
+    the key of its own task as soon as that task is finished,
+    and a task that fails is reported without the others
+    """
+    def run(task, callback):
         try:
-            callback.retval = target(task, callback)
+            return target(task, callback)
+        except Exception as e:
+            traceback.print_exc()
+            print 'Task %s failed: %s' % (str(task['key']), e)
+
+    def wrapper(tasks, callback):
+        try:
+            if group_target is not None:
+                results = group_target(tasks, callback)
+            else:
+                results = (run(task, callback) for task in tasks)
+            for retval in results:
+                callback.retval.append(retval)
+                if callback.quit: break
         except Exception as e:
             callback.fail = True
             traceback.print_exc()
             print 'Task Failed: %s' % e
 
+    def report(task, retval, callback):
+        if callback.quit and retval is None:
+            print 'Task aborted.'
+            do_update(host, port, task['key'], 'quit')
+        elif retval is None:
+            print 'Task failed!'
+            do_update(host, port, task['key'], 'fail')
+        else:
+            print 'Task finished.'
+            print 'Submitting result...'
+            if do_submit(host, port, task['key'], retval):
+                print 'Result submitted!'
+
     while True:
         print 'Getting task...'
         for attempt in count():
@@ -93,42 +126,50 @@ def client_loop(target, host, port=PORT, blacklist=None):
             print 'No task available; trying again in %d sec.' % stime
             time.sleep(2**attempt)
 
-        callback = StatusCallback(str(task['key']))
+        tasks = task.get('group', [task])
+        callback = StatusCallback(', '.join(str(t['key']) for t in tasks))
+        callback.retval = []
         if blacklist is not None and os.path.exists(blacklist):
             print 'Checking task...'
             with open(blacklist, 'r') as f:
-                for line in f:
-                    pattern = line.strip()
-                    if re.match(pattern, callback.task_string):
-                        print ('Task "%s" matches blacklist entry "%s"'
-                                % (callback.task_string, pattern))
-                        callback.quit = True
-                        break
+                patterns = [line.strip() for line in f]
+            allowed = []
+            for task in tasks:
+                task_string = str(task['key'])
+                matches = [p for p in patterns if re.match(p, task_string)]
+                if matches:
+                    print ('Task "%s" matches blacklist entry "%s"'
+                            % (task_string, matches[0]))
+                    do_update(host, port, task['key'], 'quit')
+                else:
+                    allowed.append(task)
+            tasks = allowed
+            if len(tasks) == 0:
+                callback.quit = True
 
-        if not callback.quit:
-            target_thread = Thread(target=wrapper, args=(task, callback))
+        done = 0
+        if len(tasks) > 0:
+            target_thread = Thread(target=wrapper, args=(tasks, callback))
             target_thread.daemon = True
             print 'Starting task...'
             target_thread.start()
             while target_thread.is_alive():
-                do_update(host, port, task['key'])
+                while done < len(callback.retval):
+                    report(tasks[done], callback.retval[done], callback)
+                    done += 1
+                for task in tasks[done:]:
+                    do_update(host, port, task['key'])
                 for i in range(UPDATE_INTERVAL):
-                    if not target_thread.is_alive():
+                    if (not target_thread.is_alive()
+                        or done < len(callback.retval)):
                         break
                     time.sleep(1)
             target_thread.join()
 
-        if callback.quit:
-            print 'Task aborted.'
-            do_update(host, port, task['key'], 'quit')
-        elif callback.fail or callback.retval is None:
-            print 'Task failed!'
-            do_update(host, port, task['key'], 'fail')
-        else:
-            print 'Task finished.'
-            print 'Submitting result...'
-            if do_submit(host, port, task['key'], callback.retval):
-                print 'Result submitted!'
+        for i in range(done, len(tasks)):
+            retval = (callback.retval[i] if i < len(callback.retval)
+                      else None)
+            report(tasks[i], retval, callback)
 
 def test_target(task, status_callback):
     start = time.time()
@@ -152,5 +193,6 @@ if __name__ == '__main__':
         parser.print_help()
         exit()
 
-    from experiment import client_target
-    client_loop(client_target, args[0], blacklist=options.blacklist)
+    from experiment import client_target, group_target
+    client_loop(client_target, args[0], blacklist=options.blacklist,
+                group_target=group_target)
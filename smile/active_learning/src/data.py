@@ -1,51 +1,160 @@
 """Utility for loading datasets and folds"""
 import os
 import glob
+import tempfile
 import numpy as np
+import scipy.sparse as sp
 from scipy.io import loadmat
 
-from inout import parse_c45
+from inout import parse_c45_array, stream_c45, CHUNK_SIZE
 
 DATA_DIR = 'data'
 SIVAL_DATA = 'sival.mat'
 
 CACHE = {}
+# Contents of sival.mat, by representation
+SIVAL_CACHE = {}
 
-def get_dataset(dataset_name):
-    if not dataset_name in CACHE:
+def get_dataset(dataset_name, sparse=False, streaming=False, memmap_dir=None):
+    """
+    With streaming, C4.5 datasets are read in chunks, and
+    their dense features are kept in a memory-mapped file
+    in memmap_dir (see _stream_dataset)
+    """
+    streaming = streaming and not dataset_name.startswith('sival')
+    key = dataset_key(dataset_name, sparse, streaming)
+    if not key in CACHE:
         if dataset_name.startswith('sival'):
-            ids, X, y = _get_sival_dataset(dataset_name[6:])
+            ids, X, y = _get_sival_dataset(dataset_name[6:], sparse)
+        elif streaming:
+            ids, X, y = _stream_dataset(dataset_name, sparse, memmap_dir)
         else:
-            exset = parse_c45(dataset_name, DATA_DIR)
-            raw_data = np.array(exset.to_float())
-            X = raw_data[:, 2:-1]
+            schema, raw_data = parse_c45_array(dataset_name, DATA_DIR)
+            X = normalize(raw_data[:, 2:-1], sparse)
             y = (raw_data[:, -1] == 1).reshape((-1,))
-            ids = [(ex[0], ex[1]) for ex in exset]
+            ids = zip(*[decode(schema[i], raw_data[:, i]) for i in (0, 1)])
 
-        # Normalize
+        CACHE[key] = (ids, X, y)
+    return CACHE[key]
+
+def dataset_key(dataset_name, sparse=False, streaming=False):
+    """Name of the dataset in the given representation"""
+    if sparse:
+        dataset_name = '%s_sparse' % dataset_name
+    if streaming:
+        dataset_name = '%s_streamed' % dataset_name
+    return dataset_name
+
+def decode(feature, codes):
+    """Values of an ID feature given their codes (see to_float)"""
+    return [feature.values[int(c)] for c in codes]
+
+def normalize(X, sparse=False):
+    if sparse:
+        # Centering would make X dense, so features
+        # are scaled to unit root-mean-square instead
+        rms = np.sqrt(np.average(np.square(X), axis=0))
+        rms[np.nonzero(rms == 0.0)] = 1.0
+        return sp.csr_matrix(X / rms)
+    else:
         mean = np.average(X, axis=0)
         std = np.std(X, axis=0)
+        # The computed deviation of a constant feature need
+        # not be exactly zero, so they are found by range
+        # (as in _stream_dataset), and normalized to zero
+        low = np.min(X, axis=0)
+        constant = np.nonzero(low == np.max(X, axis=0))
+        mean[constant] = low[constant]
+        std[constant] = 1.0
         std[np.nonzero(std == 0.0)] = 1.0
-        X = ((X - mean) / std)
+        return ((X - mean) / std)
+
+def _stream_dataset(dataset_name, sparse=False, memmap_dir=None):
+    """
+    Reads a C4.5 dataset in chunks, which are written to
+    a memory-mapped file in memmap_dir (or the temporary
+    directory); the mean and variance of the features are
+    computed in the same pass, by merging those of each
+    chunk (as in Welford's method), and then the file is
+    normalized in place, one chunk at a time (or, for
+    sparse features, converted to a sparse matrix)
+    """
+    schema, chunks = stream_c45(dataset_name, DATA_DIR)
+    backing = tempfile.TemporaryFile(dir=memmap_dir)
+    ids = []
+    y = []
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    low = np.inf
+    high = -np.inf
+    for chunk in chunks:
+        features = np.ascontiguousarray(chunk[:, 2:-1])
+        features.tofile(backing)
+        ids.extend(zip(*[decode(schema[i], chunk[:, i]) for i in (0, 1)]))
+        y.append(chunk[:, -1] == 1)
 
-        CACHE[dataset_name] = (ids, X, y)
-    return CACHE[dataset_name]
+        m = len(features)
+        chunk_mean = np.average(features, axis=0)
+        chunk_m2 = np.sum(np.square(features - chunk_mean), axis=0)
+        delta = chunk_mean - mean
+        mean = mean + delta*m/(n + m)
+        m2 = m2 + chunk_m2 + np.square(delta)*n*m/(n + m)
+        n += m
+        low = np.minimum(low, np.min(features, axis=0))
+        high = np.maximum(high, np.max(features, axis=0))
+
+    if n == 0:
+        raise ValueError('No examples in dataset %s' % dataset_name)
+    backing.flush()
+    X = np.memmap(backing, dtype=float, mode='r+',
+                  shape=(n, len(schema) - 3))
+    y = np.hstack(y)
+
+    if sparse:
+        # As in normalize
+        rms = np.sqrt(m2/n + np.square(mean))
+        rms[np.nonzero(rms == 0.0)] = 1.0
+        blocks = [sp.csr_matrix(X[start:start+CHUNK_SIZE] / rms)
+                  for start in xrange(0, n, CHUNK_SIZE)]
+        return ids, sp.vstack(blocks, format='csr'), y
+
+    # As in normalize, constant features are found by
+    # range, since their merged variance need not be zero
+    constant = np.nonzero(low == high)
+    mean[constant] = low[constant]
+    std = np.sqrt(m2/n)
+    std[constant] = 1.0
+    std[np.nonzero(std == 0.0)] = 1.0
+    for start in xrange(0, n, CHUNK_SIZE):
+        block = X[start:start+CHUNK_SIZE]
+        block -= mean
+        block /= std
+    X.flush()
+    return ids, X, y
 
-def _get_sival_dataset(dataset_name):
-    mat = loadmat(os.path.join(DATA_DIR, SIVAL_DATA))
-    class_id = None
-    for i, name in enumerate(mat['class_names'], 1):
-        if name.strip() == dataset_name:
-            class_id = i
-            break
+def _get_sival_dataset(dataset_name, sparse=False):
+    """
+    The SIVAL datasets have the same instances, and only
+    their labels differ, so sival.mat is loaded and its
+    features are normalized once (per representation)
+    and shared by all of them
+    """
+    if not sparse in SIVAL_CACHE:
+        mat = loadmat(os.path.join(DATA_DIR, SIVAL_DATA))
+        class_names = [name.strip() for name in mat['class_names']]
+        ids = [(str(i[0].strip()), str(i[1].strip()))
+               for i in mat['instance_ids']]
+        X = normalize(mat['X'], sparse)
+        classes = mat['y'].reshape((-1,))
+        SIVAL_CACHE[sparse] = (class_names, ids, X, classes)
+    class_names, ids, X, classes = SIVAL_CACHE[sparse]
 
-    if class_id is None:
+    if dataset_name not in class_names:
         raise Exception('Unknown SIVAL dataset: %s' % dataset_name)
 
-    ids = [(str(i[0].strip()), str(i[1].strip()))
-           for i in mat['instance_ids']]
-    X = mat['X']
-    y = (mat['y'] == class_id)
+    class_id = class_names.index(dataset_name) + 1
+    y = (classes == class_id)
     return ids, X, y
 
 def get_folds(folddir, dataset):
@@ -3,6 +3,7 @@ Implements the actual client function to run the experiment
 """
 import os
 import time
+import traceback
 import numpy as np
 from collections import defaultdict
 from sklearn.svm import SVC
@@ -10,21 +11,53 @@ from sklearn.metrics import auc_score
 
 import data
 from set_svm import SetSVM
+from kernel_cache import CACHE as KERNEL_CACHE, CACHE_LIMIT, KernelCache
 from active_learning import SVMActiveLearner
+from smo import WarmStartSVC
 
 FOLDIR = 'folds'
 
 def client_target(task, callback):
-    key = task['key']
-    params = task['params']
-    labeled = task['labeled']
+    return next(group_target([task], callback))
+
+def group_target(group, callback):
+    """
+    Runs a group of tasks on the same dataset and fold (see
+    server.py), loading the dataset and building the test bags of
+    the fold only once; the trajectories also share a cache of
+    the embeddings of bags, or of the kernels of bags with every
+    instance (see SetSVM), which they index by the rows of their
+    bags (most of which are bags of the fold)
+    @return : a generator of the result of each task as soon as it
+              is finished (None if the task failed, so that a single
+              failure does not lose the results of the other tasks)
+    """
     (technique, classifier, dataset, kernel,
-     fold, rep, initial, shuffled, queries) = key
+     fold, rep, initial, shuffled, queries) = group[0]['key']
+    params = group[0]['params']
+    fold_data = get_fold_data(dataset, fold, params.get('sparse', False),
+                              params.get('streaming', False),
+                              params.get('memmap_dir'))
 
-    print 'Starting task %s...' % str(key)
-    print 'Parameters: %s' % str(params)
+    bag_cache = KernelCache(params.get('cache_limit', CACHE_LIMIT))
+    for task in group:
+        try:
+            result = run_task(task, callback, fold_data, bag_cache)
+        except Exception as e:
+            traceback.print_exc()
+            print 'Task %s failed: %s' % (str(task['key']), e)
+            result = None
+        yield result
+        if callback.quit:
+            break
 
-    ids, X, y = data.get_dataset(dataset)
+def get_fold_data(dataset, fold, sparse=False, streaming=False,
+                  memmap_dir=None):
+    """
+    Loads the dataset, and splits it into the ids of the
+    training instances and the test bags of the given fold
+    """
+    ids, X, y = data.get_dataset(dataset, sparse, streaming, memmap_dir)
     id_index = {}
     for j, i in enumerate(ids):
         id_index[i] = j
@@ -32,44 +65,70 @@ def client_target(task, callback):
     fold = set(data.get_fold(FOLDIR, dataset, fold))
     test_ids = fold
     train_ids = set(ids) - test_ids
+
+    X_test = defaultdict(list)
+    y_test = defaultdict(bool)
+    for bid, iid in test_ids:
+        X_test[bid].append(id_index[bid, iid])
+        y_test[bid] |= bool(y[id_index[bid, iid]])
+    bags_test = sorted(X_test.keys())
+    X_test = map(np.array, [X_test[b] for b in bags_test])
+    y_test = [y_test[b] for b in bags_test]
+
+    return X, y, id_index, train_ids, bags_test, X_test, y_test
+
+def run_task(task, callback, fold_data, bag_cache=None):
+    key = task['key']
+    params = dict(task['params'])
+    # Used to load the data of the fold (see group_target)
+    params.pop('sparse', None)
+    params.pop('streaming', None)
+    warm_start = params.pop('warm_start', False)
+    KERNEL_CACHE.configure(params.pop('cache_limit', CACHE_LIMIT),
+                           params.pop('cache_dir', None))
+    labeled = task['labeled']
+    learner = task.get('learner') or {}
+    (technique, classifier, dataset, kernel,
+     fold, rep, initial, shuffled, queries) = key
+    X, y, id_index, train_ids, bags_test, X_test, y_test = fold_data
+
+    print 'Starting task %s...' % str(key)
+    print 'Parameters: %s' % str(params)
+
     labeled_ids = set((l[1], l[2]) for l in labeled)
     pool_ids = train_ids - labeled_ids
 
     X_labeled = defaultdict(list)
     y_labeled = defaultdict(bool)
     for bag, bid, iid, yi in labeled:
-        X_labeled[bag].append(X[id_index[bid, iid]])
+        X_labeled[bag].append(id_index[bid, iid])
         y_labeled[bag] |= bool(yi)
     bags_labeled = sorted(X_labeled.keys())
-    X_labeled = map(np.vstack, [X_labeled[b] for b in bags_labeled])
+    X_labeled = map(np.array, [X_labeled[b] for b in bags_labeled])
     y_labeled = [y_labeled[b] for b in bags_labeled]
 
     X_pool = defaultdict(list)
     y_pool = defaultdict(bool)
     for bid, iid in pool_ids:
-        X_pool[bid].append(X[id_index[bid, iid]])
+        X_pool[bid].append(id_index[bid, iid])
         y_pool[bid] |= bool(y[id_index[bid, iid]])
     bags_pool = sorted(X_pool.keys())
-    X_pool = map(np.vstack, [X_pool[b] for b in bags_pool])
+    X_pool = map(np.array, [X_pool[b] for b in bags_pool])
     y_pool = [y_pool[b] for b in bags_pool]
 
-    X_test = defaultdict(list)
-    y_test = defaultdict(bool)
-    for bid, iid in test_ids:
-        X_test[bid].append(X[id_index[bid, iid]])
-        y_test[bid] |= bool(y[id_index[bid, iid]])
-    bags_test = sorted(X_test.keys())
-    X_test = map(np.vstack, [X_test[b] for b in bags_test])
-    y_test = [y_test[b] for b in bags_test]
-
     results = {}
     results['stats'] = {}
     results['preds'] = {}
     start = time.time()
+    cache_counts = KERNEL_CACHE.counts()
+    if bag_cache is not None:
+        bag_counts = bag_cache.counts()
 
     if classifier == 'nsk':
-        cls = SetSVM(SVC, kernel, **params)
-        active = SVMActiveLearner(cls, queries)
+        estimator = WarmStartSVC if warm_start else SVC
+        cls = SetSVM(estimator, kernel, instances=X, incremental=True,
+                     bag_cache=bag_cache, **params)
+        active = SVMActiveLearner(cls, queries, **learner)
         predictions = active.learn(X_labeled, y_labeled, X_pool, y_pool, X_test)
     else:
         print 'Technique "%s" not supported' % technique
@@ -77,11 +136,21 @@ def client_target(task, callback):
         return
 
     results['stats']['time'] = time.time() - start
-    for q, preds in enumerate(predictions):
+    results['stats'].update(KERNEL_CACHE.counts(since=cache_counts))
+    if bag_cache is not None:
+        for name, count in bag_cache.counts(since=bag_counts).items():
+            results['stats']['bag_' + name] = count
+    if cls.approximation_error is not None:
+        results['stats']['approximation_error'] = cls.approximation_error
+    for q, preds in zip(active.checkpoints, predictions):
         results['preds'][q] = {}
         for bid, y in zip(bags_test, preds):
             results['preds'][q][bid] = float(y)
 
+    if not predictions:
+        print 'Finished task %s.' % str(key)
+        return results
+
     predictions = np.column_stack(predictions).T
     print predictions.shape
     if len(bags_test) > 1:
@@ -4,12 +4,16 @@ Parses and represents C4.5 MI data sets
 import os
 import re
 import sys
+import tempfile
 import traceback
+import numpy as np
 from collections import MutableSequence, defaultdict, Sequence
 from itertools import chain, starmap
 
 NAMES_EXT = '.names'
 DATA_EXT = '.data'
+ARRAY_EXT = '.npz'
+CHUNK_SIZE = 65536
 
 _COMMENT_RE = '//.*'
 _BINARY_RE = '\\s*0\\s*,\\s*1\\s*'
@@ -76,6 +80,23 @@ class Feature(object):
 
 Feature.CLASS = Feature("CLASS", Feature.Type.CLASS)
 
+# Storage of the values of each type of
+# feature in the columns of an ExampleSet
+CODES = 'codes'
+FLAGS = 'flags'
+VALUES = 'values'
+STORAGE_TYPES = {CODES: np.int32, FLAGS: np.int8, VALUES: float}
+
+def _storage(ftype):
+    if (ftype == Feature.Type.ID or
+        ftype == Feature.Type.NOMINAL):
+        return CODES
+    elif (ftype == Feature.Type.BINARY or
+          ftype == Feature.Type.CLASS):
+        return FLAGS
+    else:
+        return VALUES
+
 class Schema(Sequence):
     """
     Represents a schema for C4.5 data
@@ -112,47 +133,205 @@ class Schema(Sequence):
 
 class ExampleSet(MutableSequence):
     """
-    Holds a set of examples
+    Holds a set of examples, stored by columns: the
+    codes of ID and nominal values (their indices in
+    the values of the feature), binary values and
+    continuous values are each kept in an array (with
+    -1 or NaN for unknown values); the examples of the
+    set are views of its rows (see ExampleView)
     """
     def __init__(self, schema):
         self.schema = schema
-        self.examples = []
+        self.columns = []
+        self._codes = []
+        widths = defaultdict(int)
+        for feature in schema:
+            storage = _storage(feature.type)
+            self.columns.append((storage, widths[storage]))
+            widths[storage] += 1
+            codes = None
+            if storage == CODES:
+                codes = {}
+                for code, value in reversed(list(enumerate(feature.values))):
+                    codes[value] = code
+            self._codes.append(codes)
+        self.arrays = {}
+        for storage, dtype in STORAGE_TYPES.items():
+            self.arrays[storage] = np.empty((0, widths[storage]), dtype=dtype)
+        self.weights = np.empty(0)
+        self.size = 0
 
     def __len__(self):
-        return len(self.examples)
+        return self.size
 
     def __iter__(self):
-        return self.examples.__iter__()
+        return (ExampleView(self, row) for row in xrange(self.size))
 
     def __contains__(self, item):
-        return self.examples.__contains__(item)
+        if item.schema != self.schema:
+            return False
+        values = list(item)
+        return any(list(example) == values for example in self)
+
+    def index(self, item):
+        """
+        Index of the first example with the same
+        values as item (as for __contains__)
+        """
+        if item.schema == self.schema:
+            values = list(item)
+            for row, example in enumerate(self):
+                if list(example) == values:
+                    return row
+        raise ValueError('Example not in set')
 
     def __getitem__(self, key):
-        return self.examples[key]
+        if isinstance(key, slice):
+            return [ExampleView(self, row)
+                    for row in xrange(*key.indices(self.size))]
+        return ExampleView(self, self._row(key))
 
     def __setitem__(self, key, example):
+        if isinstance(key, slice):
+            rows = range(*key.indices(self.size))
+            examples = list(example)
+            if len(rows) != len(examples):
+                raise ValueError('Slice size mismatch')
+            for row, ex in zip(rows, examples):
+                self[row] = ex
+            return
         if example.schema != self.schema:
             raise ValueError('Schema mismatch')
-        self.examples[key] = example
+        self._store(self._row(key), self._encode(example), example.weight)
 
     def __delitem__(self, key):
-        del self.examples[key]
+        if isinstance(key, slice):
+            rows = range(*key.indices(self.size))
+        else:
+            rows = [self._row(key)]
+        keep = np.ones(self.size, dtype=bool)
+        keep[rows] = False
+        size = self.size - len(rows)
+        for array in self._all_arrays():
+            array[:size] = array[:self.size][keep]
+        self.size = size
 
     def insert(self, key, example):
         if example.schema != self.schema:
             raise ValueError('Schema mismatch')
-        return self.examples.insert(key, example)
+        # Read the example before moving rows (it may be one of them)
+        codes = self._encode(example)
+        weight = example.weight
+        if key < 0:
+            key = max(0, key + self.size)
+        key = min(key, self.size)
+        self._reserve(self.size + 1)
+        for array in self._all_arrays():
+            array[key+1:self.size+1] = array[key:self.size]
+        self.size += 1
+        self._store(key, codes, weight)
 
     def append(self, example):
         if example.schema != self.schema:
             raise ValueError('Schema mismatch')
         super(ExampleSet,self).append(example)
 
+    def pop(self, key=-1):
+        # A view of the row would see the rows after it
+        example = self[key].copy_of()
+        example.weight = self[key].weight
+        del self[key]
+        return example
+
+    def reverse(self):
+        for array in self._all_arrays():
+            array[:self.size] = array[:self.size][::-1].copy()
+
     def __repr__(self):
-        return '<%s, %s>' % (self.schema, self.examples)
+        return '<%s, %s>' % (self.schema, list(self))
 
     def to_float(self, normalizer=None):
-        return [ex.to_float(normalizer) for ex in self]
+        if normalizer is None:
+            normalizer = lambda x: x
+        array = self.to_array()
+        rows = array.tolist()
+        for row, i in zip(*np.nonzero(np.isnan(array))):
+            rows[row][i] = None
+        return [normalizer(row) for row in rows]
+
+    def to_array(self):
+        """
+        The examples as an array of the floats given by
+        to_float (with NaN for unknown values)
+        """
+        array = np.empty((self.size, len(self.schema)))
+        for i, (storage, j) in enumerate(self.columns):
+            column = self.arrays[storage][:self.size, j]
+            array[:, i] = column
+            if storage != VALUES:
+                array[column < 0, i] = np.nan
+        return array
+
+    def get_value(self, row, i):
+        storage, j = self.columns[i]
+        value = self.arrays[storage][row, j]
+        if storage == CODES:
+            return None if value < 0 else self.schema[i].values[value]
+        elif storage == FLAGS:
+            return None if value < 0 else bool(value)
+        else:
+            return None if np.isnan(value) else float(value)
+
+    def set_value(self, row, i, value):
+        storage, j = self.columns[i]
+        self.arrays[storage][row, j] = self._code(i, value)
+
+    def _code(self, i, value):
+        """The value of feature i as stored in its column"""
+        storage, _ = self.columns[i]
+        if value is None:
+            return np.nan if storage == VALUES else -1
+        elif storage == CODES:
+            try:
+                return self._codes[i][value]
+            except KeyError:
+                raise ValueError('Unknown value "%s" of feature %s'
+                                 % (value, self.schema[i].name))
+        return value
+
+    def _encode(self, example):
+        if len(example) != len(self.schema):
+            raise ValueError('Feature-data size mismatch')
+        return [self._code(i, value) for i, value in enumerate(example)]
+
+    def _row(self, key):
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('Example index out of range')
+        return key
+
+    def _store(self, row, codes, weight):
+        for (storage, j), code in zip(self.columns, codes):
+            self.arrays[storage][row, j] = code
+        self.weights[row] = weight
+
+    def _all_arrays(self):
+        return self.arrays.values() + [self.weights]
+
+    def _reserve(self, size):
+        """Grows the arrays geometrically to hold size examples"""
+        capacity = len(self.weights)
+        if size <= capacity:
+            return
+        capacity = max(size, 2*capacity, 16)
+        for storage, array in self.arrays.items():
+            grown = np.empty((capacity, array.shape[1]), dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[storage] = grown
+        weights = np.empty(capacity)
+        weights[:self.size] = self.weights[:self.size]
+        self.weights = weights
 
 class Example(MutableSequence):
     """
@@ -186,7 +365,7 @@ class Example(MutableSequence):
         return self.features.insert(key, item)
 
     def __repr__(self):
-        return '<%s, %s, %s>' % (self.schema, self.features, self.weight)
+        return '<%s, %s, %s>' % (self.schema, list(self), self.weight)
 
     def copy_of(self):
         ex = Example(self.schema)
@@ -200,6 +379,56 @@ class Example(MutableSequence):
         return normalizer([feature.to_float(value)
                            for feature, value in zip(self.schema, self)])
 
+class ExampleView(Example):
+    """
+    An example stored in a row of an ExampleSet; its
+    features are read from and written to the arrays
+    of the set (and cannot be inserted or deleted)
+    """
+    def __init__(self, exset, row):
+        self.schema = exset.schema
+        self.exset = exset
+        self.row = row
+
+    def __len__(self):
+        return len(self.schema)
+
+    def __iter__(self):
+        return (self.exset.get_value(self.row, i)
+                for i in range(len(self.schema)))
+
+    def __contains__(self, item):
+        return item in list(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self)[key]
+        return self.exset.get_value(self.row, self._column(key))
+
+    def __setitem__(self, key, value):
+        self.exset.set_value(self.row, self._column(key), value)
+
+    def __delitem__(self, key):
+        raise TypeError('Features of stored examples cannot be deleted')
+
+    def insert(self, key, item):
+        raise TypeError('Features of stored examples cannot be inserted')
+
+    def _column(self, key):
+        if key < 0:
+            key += len(self.schema)
+        if not 0 <= key < len(self.schema):
+            raise IndexError('Feature index out of range')
+        return key
+
+    @property
+    def weight(self):
+        return float(self.exset.weights[self.row])
+
+    @weight.setter
+    def weight(self, weight):
+        self.exset.weights[self.row] = weight
+
 class Bag(MutableSequence):
     """
     Represents a Bag
@@ -254,6 +483,72 @@ def parse_c45(file_base, rootdir='.'):
     Returns an ExampleSet from the
     C4.5 formatted data
     """
+    return _parse_c45(*_find_c45(file_base, rootdir))
+
+def parse_c45_array(file_base, rootdir='.'):
+    """
+    Returns the schema and the examples of the C4.5
+    formatted data, as an array of the floats that
+    ExampleSet.to_float would give (with NaN for
+    unknown values); the data file is read in bulk,
+    and the array is saved next to it (as a .npz file)
+    to be reused while the data and schema files keep
+    their size and modification time
+    """
+    schema_filename, data_filename = _find_c45(file_base, rootdir)
+    try:
+        schema = _parse_schema(schema_filename)
+    except Exception as e:
+        raise Exception('Error parsing schema: %s' % e)
+
+    stamp = np.array([f(filename) for filename in
+                      (schema_filename, data_filename)
+                      for f in (os.path.getmtime, os.path.getsize)])
+    array_filename = data_filename + ARRAY_EXT
+    if os.path.exists(array_filename):
+        try:
+            saved = np.load(array_filename)
+            if np.array_equal(saved['stamp'], stamp):
+                return schema, saved['examples']
+        except (IOError, ValueError, KeyError):
+            # Unreadable file; parse the data again
+            pass
+
+    try:
+        examples = _parse_example_array(schema, data_filename)
+    except ValueError:
+        # Let the example parser report bad lines
+        exset = _parse_c45(schema_filename, data_filename)
+        examples = exset.to_array()
+
+    try:
+        # Write to a temporary file first so that other
+        # clients never see a partially written file
+        handle, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(array_filename), suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            np.savez(f, stamp=stamp, examples=examples)
+        os.rename(tmp_filename, array_filename)
+    except (IOError, OSError):
+        # Read-only data directory
+        pass
+    return schema, examples
+
+def stream_c45(file_base, rootdir='.', chunk_size=CHUNK_SIZE):
+    """
+    Returns the schema of the C4.5 formatted data, and
+    an iterator over its examples in arrays of (at most)
+    chunk_size examples, as given by parse_c45_array, so
+    that the data never has to fit in memory as a whole
+    """
+    schema_filename, data_filename = _find_c45(file_base, rootdir)
+    try:
+        schema = _parse_schema(schema_filename)
+    except Exception as e:
+        raise Exception('Error parsing schema: %s' % e)
+    return schema, _parse_example_chunks(schema, data_filename, chunk_size)
+
+def _find_c45(file_base, rootdir):
     schema_name = file_base + NAMES_EXT
     data_name = file_base + DATA_EXT
     schema_file = find_file(schema_name, rootdir)
@@ -262,7 +557,7 @@ def parse_c45(file_base, rootdir='.'):
     data_file = find_file(data_name, rootdir)
     if data_file is None:
         raise ValueError('Data file not found')
-    return _parse_c45(schema_file, data_file)
+    return schema_file, data_file
 
 def _parse_c45(schema_filename, data_filename):
     """Parses C4.5 given file names"""
@@ -327,10 +622,7 @@ def _parse_feature(line, needs_id):
 def _parse_values(remainder):
     values = list()
     for raw in remainder.split(','):
-        raw = raw.strip()
-        if len(raw) > 1 and raw[0] == '"' and raw[-1] == '"':
-            raw = raw[1:-1].strip()
-        values.append(raw)
+        values.append(_unquote(raw.strip()))
     return values
 
 def _parse_examples(schema, data_filename):
@@ -370,12 +662,79 @@ def _parse_example(schema, line):
             raise ValueError('Unknown schema type "%s"' % stype)
     return ex
 
+def _parse_example_array(schema, data_filename):
+    chunks = list(_parse_example_chunks(schema, data_filename))
+    if len(chunks) == 0:
+        return np.empty((0, len(schema)))
+    return np.vstack(chunks)
+
+def _parse_example_chunks(schema, data_filename, chunk_size=CHUNK_SIZE):
+    """
+    Parses the examples column by column, chunk_size lines at
+    a time; ID and nominal values are encoded with a dictionary
+    (rather than by searching the values of the feature for each)
+    """
+    indices = []
+    for feature in schema:
+        index = None
+        if (feature.type == Feature.Type.ID or
+            feature.type == Feature.Type.NOMINAL):
+            index = {'?': np.nan}
+            for j, value in reversed(list(enumerate(feature.values))):
+                index[value] = float(j)
+        indices.append(index)
+
+    rows = []
+    with open(data_filename) as data_file:
+        for line in data_file:
+            line = _trim_line(line)
+            if len(line) == 0:
+                continue
+            values = line.split(',')
+            if len(values) != len(schema):
+                print >> sys.stderr, 'Warning: skipping line: "%s"' % line
+                continue
+            rows.append(values)
+            if len(rows) == chunk_size:
+                yield _row_array(schema, indices, rows)
+                rows = []
+    if len(rows) > 0:
+        yield _row_array(schema, indices, rows)
+
+def _row_array(schema, indices, rows):
+    examples = np.empty((len(rows), len(schema)))
+    for i, column in enumerate(zip(*rows)):
+        column = [value.strip() for value in column]
+        stype = schema[i].type
+        if indices[i] is not None:
+            try:
+                examples[:, i] = [indices[i][_unquote(value)]
+                                  for value in column]
+            except KeyError as e:
+                raise ValueError('Unknown value %s of feature %s'
+                                 % (e, schema[i].name))
+        else:
+            column = [('nan' if value == '?' else value) for value in column]
+            examples[:, i] = np.array(column, dtype=float)
+            if (stype == Feature.Type.BINARY or
+                stype == Feature.Type.CLASS):
+                binary = (examples[:, i] != 0)
+                known = ~np.isnan(examples[:, i])
+                examples[known, i] = binary[known]
+    return examples
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1].strip()
+    return value
+
 def _trim_line(line):
     """
     Removes comments and periods
     from the given line
     """
-    line = re.sub(_COMMENT_RE, '', line)
+    if '//' in line:
+        line = re.sub(_COMMENT_RE, '', line)
     line = line.strip()
     if len(line) > 0 and line[-1] == '.':
         line = line[:-1].strip()
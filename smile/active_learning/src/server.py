@@ -86,12 +86,13 @@ def plaintext(f):
 class ExperimentServer(object):
 
     def __init__(self, tasks, render, handle,
-                 task_expire=DEFAULT_TASK_EXPIRE):
+                 task_expire=DEFAULT_TASK_EXPIRE, group=None):
         self.status_lock = RLock()
         self.tasks = tasks
         self.handle = handle
         self.render = render
         self.task_expire = task_expire
+        self.group = group
 
         self.unfinished = set(self.tasks.items())
 
@@ -123,8 +124,19 @@ class ExperimentServer(object):
                 raise HTTPError(404)
             key, task = candidates.pop(0)
             task.ping()
-        arguments = {'key': key, 'params': task.params, 'labeled': task.labeled}
-        return yaml.dump(arguments)
+            if self.group is None:
+                return yaml.dump(task_arguments(key, task))
+
+            # Also hand out the waiting tasks of the same group
+            group = [(key, task)]
+            group_key = self.group(key, task)
+            for other_key, other_task in candidates:
+                if (not other_task.in_progress and
+                    self.group(other_key, other_task) == group_key):
+                    other_task.ping()
+                    group.append((other_key, other_task))
+        arguments = [task_arguments(k, t) for k, t in group]
+        return yaml.dump({'group': arguments})
 
     @plaintext
     @expose
@@ -197,11 +209,26 @@ class ExperimentServer(object):
                 task.finish()
         return "OK"
 
+def task_arguments(key, task):
+    return {'key': key, 'params': task.params, 'labeled': task.labeled,
+            'learner': task.learner}
+
+def fold_group(key, task):
+    """
+    Tasks on the same dataset and fold (of any rep, initial or
+    shuffled) with the same params, since a group is run with
+    the data (and caches) of the params of its first task
+    """
+    (technique, classifier, dataset, kernel,
+     fold, rep, initial, shuffled, queries) = key
+    return (technique, classifier, dataset, kernel, fold, queries,
+            yaml.dump(task.params))
+
 class Task(object):
 
     def __init__(self, technique, classifier, dataset, kernel,
                  fold, rep, initial, shuffled, queries,
-                 params=None, labeled=None):
+                 params=None, labeled=None, learner=None):
         self.technique = technique
         self.classifier = classifier
         self.dataset = dataset
@@ -213,6 +240,7 @@ class Task(object):
         self.queries = queries
         self.params = params
         self.labeled = labeled
+        self.learner = learner
 
         self.last_checkin = None
         self.finished = False
@@ -408,7 +436,7 @@ def setup_rep(technique, noise, dataset, fold, rep,
 
     return labeled
 
-def main(configfile, folddir, resultsdir):
+def main(configfile, folddir, resultsdir, grouped=False):
     with open(configfile, 'r') as f:
         configuration = yaml.load(f)
 
@@ -442,6 +470,7 @@ def main(configfile, folddir, resultsdir):
                                experiment['queries'])
                         kwargs = {}
                         kwargs['params'] = experiment['params']
+                        kwargs['learner'] = experiment.get('learner')
                         kwargs['labeled'] = setup_rep(technique,
                                                       experiment['noise'],
                                                       dataset, f, r, i, s,
@@ -466,14 +495,17 @@ def main(configfile, folddir, resultsdir):
         with open(pfile, 'w+') as f:
             f.write(yaml.dump(submission['preds'], default_flow_style=False))
 
-    server = ExperimentServer(tasks, render, handle)
+    group = fold_group if grouped else None
+    server = ExperimentServer(tasks, render, handle, group=group)
     cherrypy.config.update({'server.socket_port': PORT,
                             'server.socket_host': '0.0.0.0'})
     cherrypy.quickstart(server)
 
 if __name__ == '__main__':
     from optparse import OptionParser, OptionGroup
-    parser = OptionParser(usage="Usage: %prog configfile folddir resultsdir")
+    parser = OptionParser(usage="Usage: %prog [options] configfile folddir resultsdir")
+    parser.add_option('-g', '--grouped', dest='grouped',
+                      action='store_true', default=False)
     options, args = parser.parse_args()
     options = dict(options.__dict__)
     if len(args) != 3:
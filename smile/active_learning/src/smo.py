@@ -0,0 +1,125 @@
+"""
+Binary SVM on a precomputed kernel that can be
+warm-started from the solution of a previous fit
+"""
+import numpy as np
+
+class WarmStartSVC(object):
+    """
+    Solves the dual of a binary C-SVM with sequential
+    minimal optimization (SMO), using the second-order
+    working set selection of LIBSVM (without shrinking)
+
+    fit can be given initial dual coefficients alpha0
+    (e.g., alpha_ of a previous fit, padded with zeros
+    for new examples), from which it converges in few
+    iterations if the problem changed only slightly
+
+    The fitted attributes (classes_, support_,
+    dual_coef_ and intercept_) are those of sklearn's
+    SVC; alpha_ holds the dual coefficients of all
+    examples, and n_iter_ the number of iterations
+    """
+
+    def __init__(self, C=1.0, kernel='precomputed', tol=1e-3,
+                 max_iter=1000000):
+        if kernel != 'precomputed':
+            raise ValueError('WarmStartSVC needs a precomputed kernel')
+        self.C = C
+        self.tol = tol
+        self.max_iter = max_iter
+
+    def fit(self, K, y, alpha0=None):
+        K = np.asarray(K, dtype=float)
+        self.classes_ = np.unique(y)
+        if len(self.classes_) != 2:
+            raise ValueError('WarmStartSVC needs two classes')
+        y = np.where(np.asarray(y) == self.classes_[1], 1.0, -1.0)
+        n = len(y)
+        C = self.C
+
+        if alpha0 is None:
+            alpha = np.zeros(n)
+        else:
+            alpha = self._snap(np.clip(np.asarray(alpha0, dtype=float), 0, C))
+            if abs(np.dot(y, alpha)) > 1e-8*max(1.0, C*n):
+                # Not feasible (e.g., if C changed)
+                alpha = np.zeros(n)
+
+        # Gradient Q*alpha - 1 of the dual objective
+        # (with Q = diag(y)*K*diag(y))
+        support = np.nonzero(alpha)[0]
+        gradient = y*np.dot(K[:, support], y[support]*alpha[support]) - 1.0
+        diag = np.diag(K)
+
+        self.n_iter_ = 0
+        while self.n_iter_ < self.max_iter:
+            up = ((y > 0) & (alpha < C)) | ((y < 0) & (alpha > 0))
+            low = ((y > 0) & (alpha > 0)) | ((y < 0) & (alpha < C))
+            score = -y*gradient
+            if not (np.any(up) and np.any(low)):
+                break
+            i = np.argmax(np.where(up, score, -np.inf))
+            if score[i] - np.min(score[low]) < self.tol:
+                break
+
+            # Second-order choice of j among violating pairs
+            b = score[i] - score
+            candidates = low & (b > 0)
+            a = diag[i] + diag - 2*K[i]
+            a[a <= 0] = 1e-12
+            j = np.argmax(np.where(candidates, b*b/a, -np.inf))
+
+            # Step along y_i*e_i - y_j*e_j within the box
+            bound_i = C - alpha[i] if y[i] > 0 else alpha[i]
+            bound_j = alpha[j] if y[j] > 0 else C - alpha[j]
+            step = min(b[j] / a[j], bound_i, bound_j)
+            alpha[i] += y[i]*step
+            alpha[j] -= y[j]*step
+            # Keep bounds exact for the working set selection
+            if step == bound_i:
+                alpha[i] = C if y[i] > 0 else 0.0
+            if step == bound_j:
+                alpha[j] = 0.0 if y[j] > 0 else C
+            alpha[[i, j]] = self._snap(alpha[[i, j]])
+            gradient += step*y*(K[:, i] - K[:, j])
+            self.n_iter_ += 1
+
+        self.alpha_ = self._snap(alpha)
+        self.intercept_ = np.array([-self._rho(alpha, y, gradient)])
+        self.support_ = np.nonzero(alpha > 0)[0]
+        self.dual_coef_ = (y*alpha)[self.support_].reshape((1, -1))
+        return self
+
+    def _snap(self, alpha):
+        """
+        Moves coefficients within round-off of 0 or C onto the
+        bound, so that they are not taken as free support vectors
+        """
+        eps = 1e-12*self.C
+        alpha[alpha < eps] = 0.0
+        alpha[alpha > self.C - eps] = self.C
+        return alpha
+
+    def _rho(self, alpha, y, gradient):
+        """Offset of the decision function (as in LIBSVM)"""
+        yg = y*gradient
+        free = (alpha > 0) & (alpha < self.C)
+        if np.any(free):
+            return np.mean(yg[free])
+        at_upper = (alpha >= self.C)
+        upper = (at_upper & (y < 0)) | (~at_upper & (y > 0))
+        lower = ~upper
+        ub = np.min(yg[upper]) if np.any(upper) else np.inf
+        lb = np.max(yg[lower]) if np.any(lower) else -np.inf
+        if np.isinf(ub) or np.isinf(lb):
+            return ub if np.isinf(lb) else lb
+        return (ub + lb) / 2
+
+    def decision_function(self, K):
+        K = np.asarray(K)[:, self.support_]
+        return np.dot(K, self.dual_coef_[0]) + self.intercept_[0]
+
+    def predict(self, K):
+        positive = (self.decision_function(K) > 0)
+        return self.classes_[positive.astype(int)]
@@ -2,26 +2,21 @@
 import os
 import glob
 import numpy as np
+import scipy.sparse as sp
 
-from inout import parse_c45
+from inout import parse_c45_array
 
 DATA_DIR = 'data'
 
 CACHE = {}
 
-def get_dataset(dataset_name):
-    if not dataset_name in CACHE:
-        exset = parse_c45(dataset_name, DATA_DIR)
-        raw_data = np.array(exset.to_float())
-        X = raw_data[:, 2:-1]
+def get_dataset(dataset_name, sparse=False):
+    key = (dataset_name, sparse)
+    if not key in CACHE:
+        schema, raw_data = parse_c45_array(dataset_name, DATA_DIR)
+        X = normalize(raw_data[:, 2:-1], sparse)
         y = (raw_data[:, -1] == 1).reshape((-1,))
-        ids = [(ex[0], ex[1]) for ex in exset]
-
-        # Normalize
-        mean = np.average(X, axis=0)
-        std = np.std(X, axis=0)
-        std[np.nonzero(std == 0.0)] = 1.0
-        X = ((X - mean) / std)
+        ids = zip(*[decode(schema[i], raw_data[:, i]) for i in (0, 1)])
 
         bag_ids = sorted(set(i[0] for i in ids))
         data_dict = {}
@@ -31,8 +26,32 @@ def get_dataset(dataset_name):
             Y = any(y[instances].flat)
             data_dict[bid] = (bag, Y)
 
-        CACHE[dataset_name] = data_dict
-    return CACHE[dataset_name]
+        CACHE[key] = data_dict
+    return CACHE[key]
+
+def normalize(X, sparse=False):
+    if sparse:
+        # Centering would make X dense, so features
+        # are scaled to unit root-mean-square instead
+        rms = np.sqrt(np.average(np.square(X), axis=0))
+        rms[np.nonzero(rms == 0.0)] = 1.0
+        return sp.csr_matrix(X / rms)
+    else:
+        mean = np.average(X, axis=0)
+        std = np.std(X, axis=0)
+        # The computed deviation of a constant feature need
+        # not be exactly zero, so they are found by range,
+        # and normalized to zero
+        low = np.min(X, axis=0)
+        constant = np.nonzero(low == np.max(X, axis=0))
+        mean[constant] = low[constant]
+        std[constant] = 1.0
+        std[np.nonzero(std == 0.0)] = 1.0
+        return ((X - mean) / std)
+
+def decode(feature, codes):
+    """Values of an ID feature given their codes (see to_float)"""
+    return [feature.values[int(c)] for c in codes]
 
 def get_folds(folddir, dataset):
     regex = os.path.join(folddir, '%s*.fold' % dataset)
@@ -10,18 +10,22 @@ from sklearn.metrics import auc_score
 
 import data
 from set_svm import SetSVM
+from kernel_cache import CACHE as KERNEL_CACHE, CACHE_LIMIT
 
 FOLDIR = 'folds'
 
 def client_target(task, callback):
     key = task['key']
-    params = task['params']
+    params = dict(task['params'])
+    sparse = params.pop('sparse', False)
+    KERNEL_CACHE.configure(params.pop('cache_limit', CACHE_LIMIT),
+                           params.pop('cache_dir', None))
     (classifier, dataset, kernel, fold, rep) = key
 
     print 'Starting task %s...' % str(key)
     print 'Parameters: %s' % str(params)
 
-    data_dict = data.get_dataset(dataset)
+    data_dict = data.get_dataset(dataset, sparse)
 
     fold_ids = set(data.get_fold(FOLDIR, dataset, fold))
     test_ids = fold_ids
@@ -52,6 +56,8 @@ def client_target(task, callback):
         return
 
     results['stats']['time'] = time.time() - start
+    if nsk.approximation_error is not None:
+        results['stats']['approximation_error'] = nsk.approximation_error
     for i, y in zip(test_ids, predictions):
         results['preds'][i] = float(y)
 
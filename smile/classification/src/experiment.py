@@ -10,12 +10,17 @@ from sklearn.metrics import auc_score
 
 import data
 from set_svm import SetSVM
+from kernel_cache import CACHE as KERNEL_CACHE, CACHE_LIMIT
 
 FOLDIR = 'folds'
 
 def client_target(task, callback):
     key = task['key']
-    params = task['params']
+    params = dict(task['params'])
+    sparse = params.pop('sparse', False)
+    streaming = params.pop('streaming', False)
+    KERNEL_CACHE.configure(params.pop('cache_limit', CACHE_LIMIT),
+                           params.pop('cache_dir', None))
     shuffled_bags = task['shuffled_bags']
     (technique, classifier, dataset, kernel,
      fold, rep, noise, shuffled) = key
@@ -23,7 +28,8 @@ def client_target(task, callback):
     print 'Starting task %s...' % str(key)
     print 'Parameters: %s' % str(params)
 
-    ids, X, y = data.get_dataset(dataset)
+    ids, X, y = data.get_dataset(dataset, sparse, streaming,
+                                 params.get('memmap_dir'))
     id_index = {}
     for j, i in enumerate(ids):
         id_index[i] = j
@@ -35,31 +41,32 @@ def client_target(task, callback):
     X_train = defaultdict(list)
     y_train = defaultdict(bool)
     for bid, iid in train_ids:
-        X_train[bid].append(X[id_index[bid, iid]])
+        X_train[bid].append(id_index[bid, iid])
         y_train[bid] |= bool(y[id_index[bid, iid]])
     for bag, bid, iid, yi in shuffled_bags:
-        X_train[bag].append(X[id_index[bid, iid]])
+        X_train[bag].append(id_index[bid, iid])
         y_train[bag] |= bool(yi)
     bags_train = sorted(X_train.keys())
-    X_train = map(np.vstack, [X_train[b] for b in bags_train])
+    X_train = map(np.array, [X_train[b] for b in bags_train])
     y_train = [y_train[b] for b in bags_train]
 
     X_test = defaultdict(list)
     y_test = defaultdict(bool)
     for bid, iid in test_ids:
-        X_test[bid].append(X[id_index[bid, iid]])
+        X_test[bid].append(id_index[bid, iid])
         y_test[bid] |= bool(y[id_index[bid, iid]])
     bags_test = sorted(X_test.keys())
-    X_test = map(np.vstack, [X_test[b] for b in bags_test])
+    X_test = map(np.array, [X_test[b] for b in bags_test])
     y_test = [y_test[b] for b in bags_test]
 
     results = {}
     results['stats'] = {}
     results['preds'] = {}
     start = time.time()
+    cache_counts = KERNEL_CACHE.counts()
 
     if classifier == 'nsk':
-        nsk = SetSVM(SVC, kernel, **params)
+        nsk = SetSVM(SVC, kernel, instances=X, **params)
         nsk.fit(X_train, y_train)
         predictions = nsk.decision_function(X_test)
 
@@ -69,6 +76,9 @@ def client_target(task, callback):
         return
 
     results['stats']['time'] = time.time() - start
+    results['stats'].update(KERNEL_CACHE.counts(since=cache_counts))
+    if nsk.approximation_error is not None:
+        results['stats']['approximation_error'] = nsk.approximation_error
     for i, y in zip(bags_test, predictions):
         results['preds'][i] = float(y)
 
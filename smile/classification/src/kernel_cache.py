@@ -0,0 +1,215 @@
+"""
+Two-tier cache for kernel matrices: an in-memory
+LRU with a byte budget, backed by an (optional)
+directory of .npy files that are memory-mapped
+when loaded, and which can be shared by all
+clients running on the same machine
+"""
+import os
+import hashlib
+import weakref
+import tempfile
+from threading import RLock
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+
+CACHE_LIMIT = 1024*1024*1024 # 1GB
+CACHE_EXT = '.npy'
+
+class KernelCache(object):
+
+    def __init__(self, mem_limit=CACHE_LIMIT, cache_dir=None):
+        self.mem_limit = mem_limit
+        self.cache_dir = cache_dir
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, persist=True):
+        """
+        Returns the matrix stored under key,
+        calling compute() to produce it on a miss;
+        only keys that identify their contents across
+        processes should be persisted to disk
+        """
+        digest = key_digest(key)
+        with self.lock:
+            if digest in self.entries:
+                self.hits += 1
+                value = self.entries.pop(digest)
+                self.entries[digest] = value
+                return value
+
+        value = self._load(digest) if persist else None
+        if value is not None:
+            with self.lock:
+                self.disk_hits += 1
+        else:
+            with self.lock:
+                self.misses += 1
+            value = compute()
+            if persist:
+                self._save(digest, value)
+        self._remember(digest, value)
+        return value
+
+    def lookup(self, key, persist=False):
+        """
+        Returns the matrix stored under key in memory
+        (or on disk, if persist), or None (without
+        computing it)
+        """
+        digest = key_digest(key)
+        with self.lock:
+            if digest in self.entries:
+                self.hits += 1
+                value = self.entries.pop(digest)
+                self.entries[digest] = value
+                return value
+
+        value = self._load(digest) if persist else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(digest, value)
+        return value
+
+    def put(self, key, value, persist=False):
+        """Stores a matrix under key in memory (and on disk)"""
+        digest = key_digest(key)
+        if persist:
+            self._save(digest, value)
+        self._remember(digest, value)
+
+    def counts(self, since=None):
+        """
+        Hit/miss counters, optionally relative
+        to those previously returned in since
+        """
+        with self.lock:
+            counts = {'cache_hits': self.hits,
+                      'cache_disk_hits': self.disk_hits,
+                      'cache_misses': self.misses}
+        if since is not None:
+            for name in counts:
+                counts[name] -= since.get(name, 0)
+        return counts
+
+    def configure(self, mem_limit=CACHE_LIMIT, cache_dir=None):
+        """
+        Sets the byte budget and the directory of the
+        cache, evicting entries beyond the new budget
+        """
+        with self.lock:
+            self.mem_limit = mem_limit
+            self.cache_dir = cache_dir
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remember(self, digest, value):
+        if resident_bytes(value) > self.mem_limit:
+            return
+        with self.lock:
+            if digest in self.entries:
+                return
+            self.entries[digest] = value
+            self.size += resident_bytes(value)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.mem_limit:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= resident_bytes(evicted)
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest + CACHE_EXT)
+
+    def _load(self, digest):
+        if self.cache_dir is None:
+            return None
+        path = self._path(digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (IOError, ValueError):
+            # Unreadable entry; recompute it
+            return None
+
+    def _save(self, digest, value):
+        if self.cache_dir is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created concurrently by another client
+                pass
+        # Write to a temporary file first so that other
+        # clients never see a partially written entry
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, np.asarray(value))
+        os.rename(tmp_path, self._path(digest))
+
+def resident_bytes(value):
+    """
+    Bytes of memory held by a cached matrix; matrices
+    memory-mapped from the cache directory are paged
+    in (and out) by the OS, so they are not counted
+    """
+    if isinstance(value, np.memmap):
+        return 0
+    return value.nbytes
+
+def key_digest(key):
+    """
+    Content address for a cache key, which is a tuple
+    of strings and/or numpy arrays (hashed by value)
+    """
+    sha = hashlib.sha1()
+    for part in key:
+        if isinstance(part, np.ndarray):
+            sha.update(str((part.dtype, part.shape)))
+            sha.update(np.ascontiguousarray(part).view(np.uint8))
+        else:
+            sha.update(str(part))
+        sha.update('\0')
+    return sha.hexdigest()
+
+# Digests of matrices (see content_digest), by id
+DIGESTS = {}
+
+def content_digest(x):
+    """
+    Content address for a (dense or sparse) matrix, which
+    identifies it across datasets (e.g., the SIVAL classes
+    share their features) and processes; it is memoized
+    by the id of x for as long as x is alive
+    """
+    entry = DIGESTS.get(id(x))
+    if entry is not None and entry[0]() is x:
+        return entry[1]
+    if sp.issparse(x):
+        csr = x.tocsr()
+        digest = key_digest(('csr', csr.shape, csr.data,
+                             csr.indices, csr.indptr))
+    else:
+        digest = key_digest((np.asarray(x),))
+    forget = lambda ref, i=id(x): DIGESTS.pop(i, None)
+    DIGESTS[id(x)] = (weakref.ref(x, forget), digest)
+    return digest
+
+# Process-wide cache shared by all set kernels
+CACHE = KernelCache()
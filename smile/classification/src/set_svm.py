@@ -2,61 +2,265 @@
 Wraps sklearn SVM classes to allow
 for set kernels
 """
-from numpy import matrix, vstack, hstack
+from numpy import matrix, vstack
 import numpy as np
 import scipy.sparse as sp
 from scipy.spatial.distance import cdist
 from scipy.optimize import fmin_bfgs as fmin
 import math
+import tempfile
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 from progress import ProgressMonitor
+from kernel_cache import CACHE as KERNEL_CACHE, KernelCache, content_digest
 
 MEM_LIMIT = 1024*1024*1024 # 1GB
+TILE_LIMIT = 64*1024*1024 # 64MB
+
+# Options of SetSVM that configure
+# the set kernel, not the estimator
+KERNEL_OPTIONS = ('mem_limit', 'tile_limit', 'memmap_dir', 'n_jobs',
+                  'median_solver', 'dtype')
+
+# Prefixes of the parts of kernel names
+# that configure an approximation
+APPROXIMATIONS = ('ny', 'rff', 'ts', 's')
+
+# Median weights of bags, keyed by kernel and bag contents
+WEIGHT_CACHE = KernelCache(mem_limit=64*1024*1024)
 
 class SetSVM(object):
+    """
+    If an instances matrix is given, bags are
+    passed to fit/predict as arrays of row indices
+    into it, and bag kernels are composed from a
+    single instance-level kernel of the dataset,
+    which is cached (across SetSVMs) under a digest
+    of the instances matrix, so datasets with the
+    same features share it (see kernel_cache.CACHE,
+    which the experiments configure for each task)
+
+    Kernels with an approximate feature map (see
+    approximate_map) fit it to the instances of the
+    training bags, and keep the error of the
+    approximation in approximation_error
+
+    The set kernel is given to the estimator as a
+    precomputed kernel, unless kernel_on_kernel is
+    set, in which case rows of the Gram matrix are
+    used as feature vectors for the estimator's own
+    kernel (as in the original experiments); with a
+    precomputed kernel, only the support vectors are
+    kept after fitting a binary classifier
+
+    If a bag_cache (a KernelCache) is given, the embeddings
+    of bags (unless the feature map is fit to the training
+    bags, as Nystroem maps are), or, if the kernel of the
+    whole dataset is larger than mem_limit, the kernel of
+    each bag with every instance, are kept in it by the
+    rows of the bag, so that SetSVMs of the same dataset
+    (e.g., the tasks of a fold in active learning) can
+    share them
+
+    If incremental is set, the training bags and their
+    kernel are kept, so that partial_fit can add bags by
+    computing only their kernel with the training bags;
+    similarly, callers can keep the kernel between other
+    bags and the training bags (see train_kernel) up to
+    date, and get decision values from it with
+    decision_from_kernel
+    """
 
     def __init__(self, estimator_class, set_kernel, **kwargs):
-        self.set_kernel = _by_name(set_kernel)
+        self.instances = kwargs.pop('instances', None)
+        self.bag_cache = kwargs.pop('bag_cache', None)
+        options = dict((option, kwargs.pop(option))
+                       for option in KERNEL_OPTIONS if option in kwargs)
+        self.set_kernel = _by_name(set_kernel, **options)
+        self.precomputed = not kwargs.pop('kernel_on_kernel', False)
+        self.incremental = kwargs.pop('incremental', False)
+        if self.precomputed:
+            kwargs['kernel'] = 'precomputed'
         self.estimator = estimator_class(**kwargs)
+        self.approximation_error = None
+        self.train_data = None
 
     def fit(self, X, y):
-        X = map(np.asmatrix, X)
-        self.fit_data = X
-        gram_matrix = self.set_kernel(X, X)
-        self.estimator.fit(gram_matrix, y)
+        feature_map = getattr(self.set_kernel, 'feature_map', None)
+        if hasattr(feature_map, 'fit'):
+            feature_map.fit(*self._instances(X))
+            self.approximation_error = feature_map.error
+        fit_data = self._prepare(X)
+        gram_matrix = self._kernel(fit_data, fit_data)
+        return self._fit_kernel(fit_data, gram_matrix, list(y))
+
+    def partial_fit(self, X, y):
+        """
+        Adds bags X with labels y to the training bags and
+        refits the estimator; the feature map of the kernel
+        (if any) is not refit, so the kernel between the
+        training bags is reused; estimators that keep their
+        dual coefficients in alpha_ (like the WarmStartSVC
+        of the active learning experiments) are warm-started
+        from them
+        """
+        if not self.incremental:
+            raise ValueError('partial_fit needs an incremental SetSVM')
+        if self.train_data is None:
+            return self.fit(X, y)
+        new_data = self._prepare(X)
+        cross = np.asarray(self._kernel(new_data, self.train_data))
+        n, m = cross.shape[1], cross.shape[0]
+        gram_matrix = np.empty((n + m, n + m), dtype=self.train_gram.dtype)
+        gram_matrix[:n, :n] = self.train_gram
+        gram_matrix[n:, :n] = cross
+        gram_matrix[:n, n:] = cross.T
+        gram_matrix[n:, n:] = self._kernel(new_data, new_data)
+
+        alpha0 = None
+        if hasattr(self.estimator, 'alpha_'):
+            # Warm start from the previous solution
+            alpha0 = np.hstack([self.estimator.alpha_, np.zeros(m)])
+        return self._fit_kernel(concatenate(self.train_data, new_data),
+                                gram_matrix, self.train_y + list(y), alpha0)
+
+    def _fit_kernel(self, fit_data, gram_matrix, y, alpha0=None):
+        """
+        Fits the estimator to the kernel of the training bags
+        (starting from dual coefficients alpha0, if given)
+        """
+        if self.incremental:
+            self.train_data = fit_data
+            self.train_gram = np.asarray(gram_matrix)
+            self.train_y = y
+        if alpha0 is None:
+            self.estimator.fit(gram_matrix, y)
+        else:
+            self.estimator.fit(gram_matrix, y, alpha0=alpha0)
+        if self.precomputed and len(self.estimator.classes_) == 2:
+            # Predictions only need the support vectors
+            support = self.estimator.support_
+            self.fit_data = subset(fit_data, support)
+            self.dual_coef = self.estimator.dual_coef_[0]
+            self.intercept = self.estimator.intercept_[0]
+            self.support = support
+            self.support_coef = self.dual_coef
+            if hasattr(self.set_kernel, 'embed'):
+                # Collapse them into a single weight vector
+                # in the space of the bag embeddings
+                self.fit_data = np.dot(self.dual_coef, self.fit_data)
+                self.fit_data = self.fit_data.reshape((1, -1))
+                self.dual_coef = np.ones(1)
+        else:
+            self.fit_data = fit_data
+            self.dual_coef = None
         return self
 
     def predict(self, X):
-        gram_matrix = self.set_kernel(X, self.fit_data)
-        return self.estimator.predict(gram_matrix)
+        if self.dual_coef is None:
+            gram_matrix = self._kernel(self._prepare(X), self.fit_data)
+            return self.estimator.predict(gram_matrix)
+        positive = (self.decision_function(X) > 0)
+        return self.estimator.classes_[positive.astype(int)]
 
     def decision_function(self, X):
-        gram_matrix = self.set_kernel(X, self.fit_data)
-        return self.estimator.decision_function(gram_matrix)
+        gram_matrix = self._kernel(self._prepare(X), self.fit_data)
+        if self.dual_coef is None:
+            return self.estimator.decision_function(gram_matrix)
+        decision = np.dot(np.asarray(gram_matrix), self.dual_coef)
+        return decision.reshape((-1,)) + self.intercept
 
-def _by_name(full_name):
+    def kernel(self, X, Y):
+        """Set kernel between bags X and Y"""
+        return np.asarray(self._kernel(self._prepare(X), self._prepare(Y)))
+
+    def train_kernel(self, X):
+        """
+        Set kernel between bags X and the training bags
+        (in the order in which they were fit or added)
+        """
+        if not self.incremental:
+            raise ValueError('Training bags are only kept by an '
+                             'incremental SetSVM')
+        return np.asarray(self._kernel(self._prepare(X), self.train_data))
+
+    def decision_from_kernel(self, gram_matrix):
+        """
+        Decision function of bags given their
+        kernel with the training bags (see train_kernel)
+        """
+        if self.dual_coef is None:
+            return self.estimator.decision_function(gram_matrix)
+        gram_matrix = np.asarray(gram_matrix)[:, self.support]
+        decision = np.dot(gram_matrix, self.support_coef)
+        return decision.reshape((-1,)) + self.intercept
+
+    def _instances(self, X):
+        """
+        The instances of the given bags, as a matrix and
+        the rows of it that are in some bag (so that only
+        those that are sampled need to be read from it)
+        """
+        if self.instances is None:
+            instances = stack(map(as_bag, X))
+            return instances, np.arange(instances.shape[0])
+        return self.instances, np.unique(np.hstack(X).astype(int))
+
+    def _bag_cache(self):
+        """The bag cache, if what it holds can be shared"""
+        feature_map = getattr(self.set_kernel, 'feature_map', None)
+        if self.instances is None or isinstance(feature_map, NystroemMap):
+            return None
+        return self.bag_cache
+
+    def _prepare(self, X):
+        """
+        Bags in the representation used by the set kernel;
+        kernels with an explicit feature map (e.g., linear)
+        embed each bag as a single (normalized) vector
+        """
+        if self.instances is None:
+            X = map(as_bag, X)
+        else:
+            X = [np.asarray(bag, dtype=int) for bag in X]
+        if hasattr(self.set_kernel, 'embed'):
+            return self.set_kernel.embed(X, self.instances,
+                                         self._bag_cache())
+        return X
+
+    def _kernel(self, X, Y):
+        if hasattr(self.set_kernel, 'embed'):
+            return np.dot(X, Y.T)
+        elif self.instances is None:
+            return self.set_kernel(X, Y)
+        elif hasattr(self.set_kernel, 'compose'):
+            return self.set_kernel.compose(self.instances, X, Y,
+                                           self._bag_cache())
+        else:
+            bagsX = materialize(self.instances, X)
+            if id(X) == id(Y):
+                return self.set_kernel(bagsX, bagsX)
+            else:
+                return self.set_kernel(bagsX, materialize(self.instances, Y))
+
+def _by_name(full_name, **options):
     parts = full_name.split('_')
     name = parts.pop(0)
 
+    kernel_name = name
+
     try:
         # See if second part is a number
-        value = float(parts[0])
-        parts.pop(0)
+        float(parts[0])
+        kernel_name += '_' + parts.pop(0)
     except: pass
 
-    if name == 'linear':
-        kernel = linear
-    elif name == 'quadratic':
-        kernel = quadratic
-    elif name == 'p':
-        kernel = polynomial(int(value))
-    elif name == 'rbf':
-        kernel = rbf(value)
-    else:
-        raise ValueError('Unknown Kernel type %s' % name)
+    kernel, feature_map = instance_kernel(kernel_name)
 
-    try:
-        # See if remaining part is a norm
+    norm = no_norm
+    if parts and not parts[0].startswith(APPROXIMATIONS):
+        # See if next part is a norm
         norm_name = parts.pop(0)
         if norm_name == 'fs':
             norm = featurespace_norm
@@ -66,13 +270,89 @@ def _by_name(full_name):
             norm = 'median'
         else:
             raise ValueError('Unknown norm %s' % norm_name)
-    except IndexError:
-        norm = no_norm
 
-    kernel_function = set_kernel(kernel, norm)
+    if parts:
+        # Remaining parts configure an approximation
+        if norm == 'median':
+            raise ValueError('Median kernels cannot be approximated')
+        feature_map = approximate_map(kernel_name, kernel, parts)
+
+    kernel_function = set_kernel(kernel, norm, feature_map,
+                                 kernel_name=kernel_name, **options)
     kernel_function.name = full_name
+    kernel_function.kernel_name = kernel_name
     return kernel_function
 
+def instance_kernel(kernel_name):
+    """
+    Returns the instance kernel with the given name
+    (e.g., 'rbf_0.5') and its explicit feature map
+    (or None if it does not have a usable one)
+    """
+    parts = kernel_name.split('_')
+    name = parts.pop(0)
+    if parts:
+        value = float(parts[0])
+
+    feature_map = None
+    if name == 'linear':
+        kernel = linear
+        feature_map = LinearMap()
+    elif name == 'quadratic':
+        kernel = quadratic
+    elif name == 'p':
+        kernel = polynomial(int(value))
+    elif name == 'rbf':
+        kernel = rbf(value)
+    else:
+        raise ValueError('Unknown Kernel type %s' % name)
+    return kernel, feature_map
+
+def approximate_map(kernel_name, k, options):
+    """
+    Returns the approximate feature map of the instance
+    kernel k with the given name that is configured by
+    the remaining parts of a kernel name, e.g., ['ny300',
+    's1'] for a Nystroem map with 300 landmarks sampled
+    with random seed 1, ['rff1000'] for 1000 random
+    Fourier features (of rbf kernels) or ['ts1000'] for
+    a TensorSketch of size 1000 (of polynomial kernels)
+    """
+    method = None
+    seed = 0
+    for option in options:
+        if option.startswith('ny'):
+            method = 'ny'
+            size = int(option[2:])
+        elif option.startswith('rff'):
+            method = 'rff'
+            size = int(option[3:])
+        elif option.startswith('ts'):
+            method = 'ts'
+            size = int(option[2:])
+        elif option.startswith('s'):
+            seed = int(option[1:])
+        else:
+            raise ValueError('Unknown kernel option %s' % option)
+
+    parts = kernel_name.split('_')
+    name = parts.pop(0)
+    if method == 'ny':
+        return NystroemMap(k, size, seed)
+    elif method == 'rff':
+        if name != 'rbf':
+            raise ValueError('Random Fourier features need an rbf kernel')
+        return RandomFourierMap(k, float(parts[0]), size, seed)
+    elif method == 'ts':
+        if name == 'quadratic':
+            degree = 2
+        elif name == 'p':
+            degree = int(float(parts[0]))
+        else:
+            raise ValueError('TensorSketch needs a polynomial kernel')
+        return TensorSketchMap(k, degree, size, seed)
+    raise ValueError('No approximation in %s' % '_'.join(options))
+
 def averaging_norm(x, *args):
     return float(x.shape[0])
 
@@ -82,127 +362,786 @@ def featurespace_norm(x, k):
 def no_norm(x, k):
     return 1.0
 
-def _prog(plist):
-    progress = ProgressMonitor(total=len(plist), print_interval=1,
-                               msg='Constructing Kernel')
-    for p in plist:
-        yield p
-        progress.increment()
-
-def set_kernel(k, normalizer=no_norm):
+def set_kernel(k, normalizer=no_norm, feature_map=None, mem_limit=MEM_LIMIT,
+               tile_limit=TILE_LIMIT, memmap_dir=None, n_jobs=1,
+               median_solver='bfgs', kernel_name=None, dtype=float):
     """
     Decorator that makes a normalized
     set kernel out of a standard kernel k
+
+    If an explicit feature_map for k is given, the set
+    kernel can also embed bags as single vectors (see
+    embed), so that it is a dot product of embeddings
+
+    Instance-level kernels are computed in tiles of at
+    most tile_limit bytes; if they are larger than
+    mem_limit bytes and memmap_dir is given, the resulting
+    bag-level kernel is stored in a memory-mapped file in
+    that directory
+
+    With n_jobs > 1, rows of tiles of kernel matrices
+    are computed concurrently by that many threads (the
+    tiles do not depend on n_jobs, nor do the results)
+
+    If normalizer is 'median', each bag is represented by
+    the geometric median of its instances in the feature
+    space of k (see median_weight), and the instances in
+    the sums above are weighted accordingly
+
+    Instance features and kernel matrices are stored with
+    the given dtype (e.g., 'float32' to halve their size),
+    but sums over bags are accumulated in double precision
     """
-    # Check special case
-    # (kind of a hack; make it better eventually)
-    if normalizer == 'median':
-        return median_kernel(k)
+    n_jobs = pool_size(n_jobs)
+    dtype = np.dtype(dtype)
+    itemsize = dtype.itemsize
+
+    median = (normalizer == 'median')
+    if median:
+        median_weights = weigher(k, kernel_name, n_jobs, median_solver)
+    # Cached bag columns and embeddings depend on the median weights
+    solver = median_solver if median else None
 
     def K(X, Y):
         if type(X) == list:
-            norm = lambda x: normalizer(x, k)
-            xinst = sum(map(len, X))
-            yinst = sum(map(len, Y))
-            if xinst*yinst*8 >= MEM_LIMIT:
-                x_norm = matrix(map(norm, X))
-                y_norm = matrix(map(norm, Y))
-                norms = x_norm.T*y_norm
-                raw_kernel = np.array([[np.sum(k(x,y)) for y in Y]
-                                       for x in _prog(X)])
+            symmetric = (id(X) == id(Y))
+            if median:
+                x_weights = np.hstack(median_weights(X))
+                if symmetric:
+                    y_weights = x_weights
+                else:
+                    y_weights = np.hstack(median_weights(Y))
+                weights = (x_weights, y_weights)
             else:
+                norm = lambda x: normalizer(x, k)
                 x_norm = matrix(map(norm, X))
-                if id(X) == id(Y):
-                    # Optimize for symmetric case
-                    norms = x_norm.T*x_norm
-                    if all(len(bag) == 1 for bag in X):
-                        # Optimize for singleton bags
-                        instX = vstack(X)
-                        raw_kernel = k(instX, instX)
-                    else:
-                        # Only need to compute half of
-                        # the matrix if it's symmetric
-                        upper = matrix([i*[0] + [np.sum(k(x, y))
-                                                 for y in Y[i:]]
-                                        for i, x in enumerate(X, 1)])
-                        diag = np.array([np.sum(k(x, x)) for x in X])
-                        raw_kernel = upper + upper.T + spdiag(diag)
+                if symmetric:
+                    y_norm = x_norm
                 else:
                     y_norm = matrix(map(norm, Y))
-                    norms = x_norm.T*y_norm
-                    raw_kernel = k(vstack(X), vstack(Y))
-                    lensX = map(len, X)
-                    lensY = map(len, Y)
-                    if any(l != 1 for l in lensX):
-                        raw_kernel = vstack([np.sum(raw_kernel[i:j, :], axis=0)
-                                             for i, j in slices(lensX)])
-                    if any(l != 1 for l in lensY):
-                        raw_kernel = hstack([np.sum(raw_kernel[:, i:j], axis=1)
-                                             for i, j in slices(lensY)])
-            return np.divide(raw_kernel, norms)
+                norms = x_norm.T*y_norm
+                weights = None
+
+            xinst = sum(lengths(X))
+            yinst = sum(lengths(Y))
+            if xinst*yinst*itemsize >= mem_limit:
+                raw_kernel = tiled_kernel(k, X, Y, tile_limit, memmap_dir,
+                                          n_jobs, weights, dtype)
+            else:
+                raw_kernel = tiled_kernel(k, X, Y, tile_limit, n_jobs=n_jobs,
+                                          weights=weights, dtype=dtype)
+            if median:
+                return raw_kernel
+            # Normalize in place to avoid a second copy
+            return np.divide(raw_kernel, norms, raw_kernel)
         else:
             return k(X, Y)
+
+    def compose(instances, X, Y, bag_cache=None):
+        """
+        Kernel between bags of row indices into instances,
+        computed as S_X*G*S_Y' with sparse bag-membership
+        matrices S (holding the instance weights of median
+        kernels) and an instance-level kernel matrix G; if
+        a bag_cache is given, the columns G*S_Y' are shared
+        through it when G is too large to be cached whole
+        """
+        symmetric = (id(X) == id(Y))
+        n = instances.shape[0]
+        columns = None
+        if n*n*itemsize < mem_limit:
+            # Kernel of the whole dataset; reused across calls
+            # (and datasets with the same instances)
+            rows = cols = np.arange(n)
+            key = (content_digest(instances), K.kernel_name,
+                   dtype.name, rows)
+            gram = KERNEL_CACHE.get(key,
+                lambda: threaded_kernel(k, instances, instances,
+                                        tile_limit, n_jobs, dtype))
+        elif bag_cache is not None and n*len(Y)*itemsize < mem_limit:
+            # Kernel of each bag of Y with every instance
+            rows = np.arange(n)
+            columns = bag_columns(instances, Y, bag_cache)
+        else:
+            # Only the instances that appear in some bag; reused
+            # by calls (and datasets) with the same instances
+            rows = np.unique(np.hstack(X))
+            cols = rows if symmetric else np.unique(np.hstack(Y))
+            if len(rows)*len(cols)*itemsize >= mem_limit:
+                # Computed in tiles (as by K), whose instances
+                # are read from instances one at a time
+                weights = None
+                if median:
+                    x_weights = np.hstack(bag_weights(instances, X))
+                    if symmetric:
+                        y_weights = x_weights
+                    else:
+                        y_weights = np.hstack(bag_weights(instances, Y))
+                    weights = (x_weights, y_weights)
+                raw_kernel = tiled_kernel(k, X, Y, tile_limit, memmap_dir,
+                                          n_jobs, weights, dtype, instances)
+                if median:
+                    return raw_kernel
+                return np.divide(raw_kernel, bag_norms(instances, X, Y),
+                                 raw_kernel)
+            key = (content_digest(instances), K.kernel_name,
+                   dtype.name, rows, cols)
+            gram = KERNEL_CACHE.get(key,
+                lambda: threaded_kernel(k, instances, instances[cols],
+                                        tile_limit, n_jobs, dtype, rows))
+
+        if median:
+            x_weights = bag_weights(instances, X)
+            S_X = membership(X, rows, x_weights)
+        else:
+            S_X = membership(X, rows)
+        if columns is not None:
+            raw_kernel = S_X.dot(columns)
+        else:
+            if symmetric:
+                S_Y = S_X
+            elif median:
+                y_weights = bag_weights(instances, Y)
+                S_Y = membership(Y, cols, y_weights)
+            else:
+                S_Y = membership(Y, cols)
+            # Multiplied by the membership matrix with fewer
+            # entries first, so the kernel of a few (e.g., newly
+            # labeled) bags only costs the instance columns of
+            # those bags, rather than a pass over all of G
+            if S_X.nnz*len(cols) <= S_Y.nnz*len(rows):
+                raw_kernel = S_Y.dot(S_X.dot(gram).T).T
+            else:
+                # Only the columns of G of the instances of Y
+                # (transposed to rows, as sparse products need)
+                used = np.unique(S_Y.indices)
+                part = np.ascontiguousarray(gram[:, used].T)
+                raw_kernel = S_X.dot(S_Y[:, used].dot(part).T)
+        raw_kernel = cast(raw_kernel, dtype)
+        if median:
+            return matrix(raw_kernel)
+
+        raw_kernel = matrix(raw_kernel)
+        return np.divide(raw_kernel, bag_norms(instances, X, Y), raw_kernel)
+
+    def bag_norms(instances, X, Y):
+        """Products of the normalizers of bags of row indices"""
+        norm = lambda bag: normalizer(as_bag(instances[bag]), k)
+        x_norm = matrix(map(norm, X))
+        if id(X) == id(Y):
+            y_norm = x_norm
+        else:
+            y_norm = matrix(map(norm, Y))
+        return x_norm.T*y_norm
+
+    def bag_weights(instances, X):
+        """
+        Median weights of bags of row indices, whose
+        instances are read a block of bags at a time
+        """
+        size = max(1, tile_limit / (itemsize*instances.shape[1]))
+        weights = []
+        for bags, _ in blocks(lengths(X), size):
+            weights.extend(median_weights(materialize(instances, X[bags])))
+        return weights
+
+    def bag_columns(instances, bags, bag_cache):
+        """
+        Kernel of every instance with each bag (the sum
+        of its columns of the instance-level kernel),
+        looked up in or added to bag_cache, and to the
+        process-wide cache (and its directory), so that
+        they are also shared by other groups of tasks
+        and clients with the same instances
+        """
+        digest = content_digest(instances)
+        keys = [(digest, K.name, solver, dtype.name, bag)
+                for bag in bags]
+        columns = map(bag_cache.lookup, keys)
+        for i, column in enumerate(columns):
+            if column is None:
+                columns[i] = KERNEL_CACHE.lookup(keys[i], persist=True)
+                if columns[i] is not None:
+                    bag_cache.put(keys[i], columns[i])
+        missing = [i for i, column in enumerate(columns) if column is None]
+        if missing:
+            new_bags = [bags[i] for i in missing]
+            cols = np.unique(np.hstack(new_bags))
+            weights = None
+            if median:
+                weights = bag_weights(instances, new_bags)
+            gram = threaded_kernel(k, instances, instances[cols],
+                                   tile_limit, n_jobs, dtype)
+            sums = membership(new_bags, cols, weights).dot(gram.T)
+            for i, column in zip(missing, cast(sums, dtype)):
+                # Copied, so that evicting it frees its memory
+                columns[i] = column.copy()
+                bag_cache.put(keys[i], columns[i])
+                KERNEL_CACHE.put(keys[i], columns[i], persist=True)
+        return np.column_stack(columns)
+
+    K.compose = compose
+
+    if feature_map is None:
+        return K
+
+    def embed(X, instances=None, bag_cache=None):
+        """
+        Embeds each bag as the sum of the feature vectors
+        of its instances, divided by its normalizer (or as
+        their median-weighted sum); bags are given as row
+        indices if instances is given, and their embeddings
+        are then looked up in or added to bag_cache (if any)
+        """
+        if instances is not None and bag_cache is not None:
+            digest = content_digest(instances)
+            keys = [(digest, K.name, solver, dtype.name, bag)
+                for bag in X]
+            embeddings = map(bag_cache.lookup, keys)
+            missing = [i for i, e in enumerate(embeddings) if e is None]
+            if missing:
+                computed = embed([X[i] for i in missing], instances)
+                for i, embedding in zip(missing, computed):
+                    embeddings[i] = embedding.copy()
+                    bag_cache.put(keys[i], embeddings[i])
+            return np.vstack(embeddings)
+
+        lens = np.array(lengths(X), dtype=float)
+        if instances is None:
+            features = cast(feature_map.transform(stack(X)), dtype)
+            weights = None
+            if median:
+                weights = np.hstack(median_weights(X))
+            if sp.issparse(features):
+                sums = dense(summation(lengths(X), weights).dot(features))
+            else:
+                if weights is not None:
+                    features = features * weights.reshape((-1, 1))
+                sums = np.add.reduceat(features, offsets(lengths(X)),
+                                       axis=0, dtype=np.float64)
+        else:
+            # Features are computed for (and read from instances)
+            # one block of rows at a time
+            rows = np.unique(np.hstack(X))
+            weights = None
+            if median:
+                weights = bag_weights(instances, X)
+            S = membership(X, rows, weights).tocsc()
+            size = max(1, tile_limit / (itemsize*instances.shape[1]))
+            sums = 0
+            for start in xrange(0, len(rows), size):
+                block = slice(start, start + size)
+                features = cast(feature_map.transform(instances[rows[block]]),
+                                dtype)
+                sums = sums + dense(S[:, block].dot(features))
+
+        if median:
+            return cast(sums, dtype)
+        elif normalizer == averaging_norm:
+            norms = lens
+        elif normalizer == featurespace_norm:
+            norms = np.sqrt(np.sum(np.square(sums), axis=1))
+        else:
+            norms = np.ones(len(X))
+        return cast(sums / norms.reshape((-1, 1)), dtype)
+
+    K.embed = embed
+    K.feature_map = feature_map
     return K
 
+def tiled_kernel(k, X, Y, tile_limit=TILE_LIMIT, memmap_dir=None, n_jobs=1,
+                 weights=None, dtype=float, instances=None):
+    """
+    Computes the unnormalized set kernel between lists of
+    bags X and Y one tile of instances at a time, so that
+    no instance-level block is (much) larger than tile_limit
+    bytes; each tile is reduced to bag sums immediately, and
+    rows of tiles are distributed across n_jobs threads
+
+    If given, weights is a pair of arrays with a weight
+    for each instance of X and Y (in order), by which the
+    rows and columns of the tiles are scaled before summing
+
+    If instances is given, bags are arrays of row indices
+    into it, and the instances of each tile are read from
+    it (e.g., a memory-mapped file) only when needed
+
+    The instances, tiles and kernel are stored with the
+    given dtype, but the sums are accumulated as doubles
+    """
+    dtype = np.dtype(dtype)
+    symmetric = (id(X) == id(Y))
+    lensX = lengths(X)
+    lensY = lengths(Y)
+    if instances is None:
+        instX = cast(stack(X), dtype)
+        instY = instX if symmetric else cast(stack(Y), dtype)
+        read = lambda inst, i: inst[i]
+    else:
+        instX = np.hstack(X)
+        instY = instX if symmetric else np.hstack(Y)
+        read = lambda rows, i: cast(instances[rows[i]], dtype)
+
+    side = max(1, int(math.sqrt(tile_limit / dtype.itemsize)))
+    x_blocks = list(blocks(lensX, side))
+    y_blocks = x_blocks if symmetric else list(blocks(lensY, side))
+
+    shape = (len(X), len(Y))
+    if memmap_dir is None:
+        raw_kernel = np.zeros(shape, dtype=dtype)
+    else:
+        backing = tempfile.TemporaryFile(dir=memmap_dir)
+        raw_kernel = np.memmap(backing, dtype=dtype, mode='w+', shape=shape)
+
+    def tile_row(i):
+        # Rows of tiles write to disjoint parts of the kernel
+        xb, xi = x_blocks[i]
+        x = read(instX, xi)
+        for j, (yb, yi) in enumerate(y_blocks):
+            if symmetric and j < i:
+                # Filled in from the transposed tile
+                continue
+            y = x if symmetric and j == i else read(instY, yi)
+            if weights is None:
+                tile = bag_sums(k(x, y), lensX[xb], lensY[yb])
+            else:
+                tile = bag_sums(k(x, y), lensX[xb], lensY[yb],
+                                weights[0][xi], weights[1][yi])
+            raw_kernel[xb, yb] = tile
+            if symmetric and j > i:
+                raw_kernel[yb, xb] = tile.T
+
+    progress = ProgressMonitor(total=len(x_blocks), print_interval=1,
+                               msg='Constructing Kernel')
+    for _ in parallel_map(tile_row, range(len(x_blocks)), n_jobs):
+        progress.increment()
+    return raw_kernel
+
+def threaded_kernel(k, A, B, tile_limit=TILE_LIMIT, n_jobs=1, dtype=float,
+                    rows=None):
+    """
+    Instance-level kernel matrix (of the given dtype)
+    between A (or the given rows of A) and B, computed in
+    blocks of rows of at most tile_limit bytes, which are
+    read from A (e.g., a memory-mapped file) one at a time
+    and distributed across n_jobs threads
+    """
+    dtype = np.dtype(dtype)
+    B = cast(B, dtype)
+    n = A.shape[0] if rows is None else len(rows)
+    size = max(1, tile_limit / (dtype.itemsize*B.shape[0]))
+    row_blocks = [slice(i, i + size) for i in range(0, n, size)]
+    if rows is not None:
+        row_blocks = [rows[r] for r in row_blocks]
+    block = lambda r: cast(np.asarray(k(cast(A[r], dtype), B)), dtype)
+    return np.vstack(parallel_map(block, row_blocks, n_jobs))
+
+def parallel_map(f, items, n_jobs=1, processes=False):
+    """
+    Maps f over items with a pool of n_jobs threads (or
+    processes, for which f and the items must be picklable)
+    and returns the results in order
+    """
+    n_jobs = pool_size(n_jobs)
+    if n_jobs <= 1 or len(items) <= 1:
+        return map(f, items)
+    pool = Pool(n_jobs) if processes else ThreadPool(n_jobs)
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def pool_size(n_jobs):
+    """Number of workers for n_jobs (all CPUs if negative)"""
+    if n_jobs < 0:
+        return cpu_count()
+    return n_jobs
+
+def blocks(groups, size):
+    """
+    Partitions consecutive groups of the given sizes into
+    blocks of at most size elements (unless a single group
+    is larger); yields the slice of groups and the slice of
+    elements covered by each block
+    """
+    first = 0
+    start = 0
+    count = 0
+    for g, group in enumerate(groups):
+        if count > 0 and count + group > size:
+            yield slice(first, g), slice(start, start + count)
+            first = g
+            start += count
+            count = 0
+        count += group
+    if count > 0:
+        yield slice(first, len(groups)), slice(start, start + count)
+
+class LinearMap(object):
+    """
+    Explicit feature map of the
+    linear kernel (the identity)
+    """
+
+    def transform(self, instances):
+        return as_array(instances)
+
+class NystroemMap(object):
+    """
+    Approximate feature map of kernel k spanned by
+    the kernel functions of n_landmarks instances,
+    which fit samples (with the given random seed);
+    error is the relative (Frobenius) error of the
+    approximate kernel on a held-out sample of
+    at most n_heldout other instances
+    """
+
+    def __init__(self, k, n_landmarks, seed=0, n_heldout=500):
+        self.k = k
+        self.n_landmarks = n_landmarks
+        self.seed = seed
+        self.n_heldout = n_heldout
+        self.landmarks = None
+        self.error = None
+
+    def fit(self, instances, rows=None):
+        """Fits the map to the given rows of instances (or all)"""
+        if rows is None:
+            rows = np.arange(instances.shape[0])
+        order = rows[np.random.RandomState(self.seed).permutation(len(rows))]
+        self.landmarks = as_array(instances[order[:self.n_landmarks]])
+
+        # Whitening of the kernel functions of the landmarks
+        # (dropping directions in which they are degenerate)
+        values, vectors = np.linalg.eigh(np.asarray(
+            self.k(self.landmarks, self.landmarks)))
+        keep = (values > 1e-10*np.max(values))
+        self.components = vectors[:, keep] / np.sqrt(values[keep])
+
+        heldout = order[self.n_landmarks:self.n_landmarks + self.n_heldout]
+        if len(heldout) == 0:
+            heldout = order[:self.n_heldout]
+        self.error = approximation_error(self, as_array(instances[heldout]))
+        return self
+
+    def transform(self, instances):
+        return np.dot(np.asarray(self.k(as_array(instances),
+                                        self.landmarks)),
+                      self.components)
+
+class RandomFourierMap(object):
+    """
+    Random Fourier features of the rbf kernel k with
+    parameter gamma; the n_features random frequencies
+    and phases are drawn (with the given random seed)
+    once the number of input features is known, so they
+    do not depend on the data; fit only estimates the
+    error of the approximate kernel on (at most
+    n_heldout) of the given instances
+    """
+
+    def __init__(self, k, gamma, n_features, seed=0, n_heldout=500):
+        self.k = k
+        self.gamma = gamma
+        self.n_features = n_features
+        self.seed = seed
+        self.n_heldout = n_heldout
+        self.frequencies = None
+        self.error = None
+
+    def fit(self, instances, rows=None):
+        """Estimates the error on the given rows of instances"""
+        self.error = approximation_error(self,
+            heldout_sample(instances, self.n_heldout, self.seed, rows))
+        return self
+
+    def transform(self, instances):
+        instances = as_array(instances)
+        if self.frequencies is None:
+            random = np.random.RandomState(self.seed)
+            self.frequencies = random.normal(scale=math.sqrt(2*self.gamma),
+                size=(instances.shape[1], self.n_features))
+            self.phases = random.uniform(0, 2*np.pi, self.n_features)
+        projections = instances.dot(self.frequencies) + self.phases
+        return math.sqrt(2.0 / self.n_features) * np.cos(projections)
+
+class TensorSketchMap(object):
+    """
+    TensorSketch of size n_features of the polynomial
+    kernel k (1 + x'*y)^degree: the product (as a
+    circular convolution) of degree count sketches of
+    each instance with a constant feature appended;
+    the hash functions are drawn (with the given random
+    seed) once the number of input features is known,
+    so they do not depend on the data; fit only
+    estimates the error of the approximate kernel on
+    (at most n_heldout) of the given instances
+    """
+
+    def __init__(self, k, degree, n_features, seed=0, n_heldout=500):
+        self.k = k
+        self.degree = degree
+        self.n_features = n_features
+        self.seed = seed
+        self.n_heldout = n_heldout
+        self.sketches = None
+        self.error = None
+
+    def fit(self, instances, rows=None):
+        """Estimates the error on the given rows of instances"""
+        self.error = approximation_error(self,
+            heldout_sample(instances, self.n_heldout, self.seed, rows))
+        return self
+
+    def transform(self, instances):
+        instances = as_array(instances)
+        constant = np.ones((instances.shape[0], 1))
+        if sp.issparse(instances):
+            instances = sp.hstack([instances, constant], format='csr')
+        else:
+            instances = np.hstack([instances, constant])
+        n_instances, n = instances.shape
+        if self.sketches is None:
+            random = np.random.RandomState(self.seed)
+            self.sketches = []
+            for _ in range(self.degree):
+                hashes = random.randint(self.n_features, size=n)
+                signs = random.choice([-1.0, 1.0], size=n)
+                self.sketches.append(sp.csr_matrix((signs,
+                    (np.arange(n), hashes)), shape=(n, self.n_features)))
+        product = np.ones((n_instances, self.n_features), dtype=complex)
+        for sketch in self.sketches:
+            counts = dense(sketch.T.dot(instances.T)).T
+            product *= np.fft.fft(counts, axis=1)
+        return np.real(np.fft.ifft(product, axis=1))
+
+def heldout_sample(instances, size, seed=0, rows=None):
+    """
+    Random sample of at most size instances
+    (of the given rows of instances, if any)
+    """
+    if rows is None:
+        rows = np.arange(instances.shape[0])
+    order = rows[np.random.RandomState(seed).permutation(len(rows))]
+    return as_array(instances[order[:size]])
+
+def approximation_error(feature_map, instances):
+    """
+    Relative (Frobenius) error of the kernel matrix of
+    the given instances under an approximate feature map
+    """
+    exact = np.asarray(feature_map.k(instances, instances))
+    features = feature_map.transform(instances)
+    approximate = np.dot(features, features.T)
+    return np.linalg.norm(exact - approximate) / np.linalg.norm(exact)
+
 def linear(x, y):
     """Linear kernel x'*y"""
-    return np.dot(x, y.T)
+    return dot(x, y)
 
 def quadratic(x, y):
     """Quadratic kernel (1 + x'*y)^2"""
-    return np.square(1e0 + np.dot(x,y.T))
+    return np.square(1e0 + dot(x, y))
 
 def polynomial(p):
     """General polynomial kernel (1 + x'*y)^p"""
     def p_kernel(x, y):
-        return np.power(1e0 + np.dot(x,y.T), p)
+        return np.power(1e0 + dot(x, y), p)
     return p_kernel
 
 def rbf(gamma):
     """Radial Basis Function"""
     def rbf_kernel(x, y):
-        return matrix(np.exp(-gamma*cdist(x, y, 'sqeuclidean')))
+        return matrix(np.exp(-gamma*sqeuclidean(x, y)))
     return rbf_kernel
 
-def slices(groups):
+def dot(x, y):
     """
-    Generate slices to select
-    groups of the given sizes
-    within a list/matrix
+    Matrix of dot products between the rows of x and
+    y (dense, even if x or y is a sparse matrix)
     """
-    i = 0
-    for group in groups:
-        yield i, i + group
-        i += group
+    if sp.issparse(x):
+        return dense(x.dot(y.T))
+    elif sp.issparse(y):
+        return dense(y.dot(x.T)).T
+    return np.dot(x, y.T)
 
-def spdiag(x):
-    n = len(x)
-    return sp.spdiags(x.flat, [0], n, n)
+def sqeuclidean(x, y):
+    """
+    Matrix of squared distances between the rows
+    of x and y (which may be sparse matrices)
+    """
+    if not (sp.issparse(x) or sp.issparse(y)):
+        return cdist(x, y, 'sqeuclidean')
+    xx = squared_norms(x).reshape((-1, 1))
+    yy = squared_norms(y).reshape((1, -1))
+    # Clip round-off below zero
+    return np.maximum(xx + yy - 2*dot(x, y), 0)
+
+def squared_norms(x):
+    """Squared norms of the rows of x"""
+    if sp.issparse(x):
+        return np.asarray(x.multiply(x).sum(axis=1)).reshape((-1,))
+    return np.sum(np.square(np.asarray(x)), axis=1)
+
+def as_bag(x):
+    """
+    A bag of instances as a matrix (sparse
+    bags are kept in CSR format instead)
+    """
+    if sp.issparse(x):
+        return sp.csr_matrix(x)
+    return np.asmatrix(x)
+
+def as_array(x):
+    """
+    Instances as an array (sparse instances
+    are kept in CSR format instead)
+    """
+    if sp.issparse(x):
+        return sp.csr_matrix(x)
+    return np.asarray(x)
+
+def cast(x, dtype):
+    """x as the given dtype (copied only if needed)"""
+    return x.astype(dtype, copy=False)
+
+def dense(x):
+    """Dense array of a (possibly sparse) matrix"""
+    if sp.issparse(x):
+        return x.toarray()
+    return np.asarray(x)
 
-def median_weight(k, X):
-    n = len(X)
-    K = k(X, X)
+def stack(bags):
+    """Stacks the instances of (possibly sparse) bags"""
+    if any(sp.issparse(bag) for bag in bags):
+        return sp.vstack(bags, format='csr')
+    return vstack(bags)
+
+def lengths(bags):
+    """Numbers of instances in (possibly sparse) bags"""
+    return [bag.shape[0] for bag in bags]
+
+def offsets(groups):
+    """
+    Starting index of each group of the given
+    sizes within a list/matrix
+    """
+    return np.cumsum([0] + list(groups[:-1]))
+
+def bag_sums(raw_kernel, lensX, lensY, weightsX=None, weightsY=None):
+    """
+    Reduces an instance-level kernel matrix to a
+    bag-level one by summing the entries within
+    each block of rows and columns of a bag (after
+    scaling them by the given instance weights)
+    """
+    raw_kernel = np.asarray(raw_kernel)
+    if raw_kernel.dtype != np.float64:
+        # Accumulate sums in double precision
+        raw_kernel = raw_kernel.astype(np.float64)
+    if weightsX is not None:
+        raw_kernel = raw_kernel * weightsX.reshape((-1, 1))
+    if weightsY is not None:
+        raw_kernel = raw_kernel * weightsY.reshape((1, -1))
+    # Reduce first along the axis that leaves the smaller matrix
+    axes = [(0, lensX), (1, lensY)]
+    if len(lensX)*raw_kernel.shape[1] > raw_kernel.shape[0]*len(lensY):
+        axes.reverse()
+    for axis, lens in axes:
+        if any(l != 1 for l in lens):
+            raw_kernel = np.add.reduceat(raw_kernel, offsets(lens), axis=axis)
+    return matrix(raw_kernel)
+
+def membership(bags, instances, weights=None):
+    """
+    Sparse bag-membership matrix with a 1 at (b, j) if the
+    j-th of the given (sorted) instance indices is in bag b
+    (or the weight of that instance in the bag, if a list
+    of weights of each bag's instances is given)
+    """
+    indices = np.searchsorted(instances, np.hstack(bags))
+    indptr = np.cumsum([0] + map(len, bags))
+    if weights is None:
+        data = np.ones(len(indices))
+    else:
+        data = np.hstack(weights)
+    return sp.csr_matrix((data, indices, indptr),
+                         shape=(len(bags), len(instances)))
+
+def summation(lens, weights=None):
+    """
+    Sparse matrix that sums (with the given weights,
+    if any) consecutive groups of rows of the given sizes
+    """
+    n = sum(lens)
+    indptr = np.cumsum([0] + list(lens))
+    if weights is None:
+        weights = np.ones(n)
+    return sp.csr_matrix((weights, np.arange(n), indptr),
+                         shape=(len(lens), n))
+
+def concatenate(bags, more_bags):
+    """
+    Concatenates two lists of bags (or
+    matrices of bag embeddings)
+    """
+    if isinstance(bags, np.ndarray):
+        return np.vstack([bags, more_bags])
+    return bags + more_bags
+
+def subset(bags, indices):
+    """
+    Selects the given bags (a list of
+    bags or a matrix of bag embeddings)
+    """
+    if isinstance(bags, np.ndarray):
+        return bags[indices]
+    return [bags[i] for i in indices]
+
+def materialize(instances, bags):
+    """
+    Turns bags of row indices into instances
+    into bags of instance feature vectors
+    """
+    return [as_bag(instances[bag]) for bag in bags]
+
+def median_weight(k, X, solver='bfgs'):
+    """
+    Weights of the instances in bag X whose combination (in
+    the feature space of k) is the geometric median of the
+    bag, found with BFGS or (if solver is 'weiszfeld') with
+    Weiszfeld's fixed-point iterations
+    """
+    n = X.shape[0]
+    K = np.asarray(k(X, X))
     a0 = np.ones(n) / float(n)
     if n <= 2:
         return a0
 
+    diag = np.diag(K)
+
     def distances(a):
-        a = np.asarray(a)
-        sq_dists = np.array([float(K[i, i] - 2 * np.dot(K[i, :], a) + np.dot(np.dot(a.T, K), a))
-                             for i in range(n)])
-        return np.sqrt(sq_dists)
+        Ka = np.dot(K, a)
+        return np.sqrt(diag - 2*Ka + np.dot(a, Ka))
+
+    if solver == 'weiszfeld':
+        return weiszfeld(distances, a0)
+    elif solver != 'bfgs':
+        raise ValueError('Unknown median solver %s' % solver)
 
     def f(a):
         return np.sum(distances(a))
 
     def grad(a):
-        a = np.asarray(a)
         dists = distances(a)
-        g = sum((np.dot(K, a) - K[i, :]) / dists[i]
-                 for i in range(n) if dists[i] != 0)
-        if type(g) == int:
+        nonzero = (dists != 0)
+        if not np.any(nonzero):
             return np.zeros(a.shape)
-        return np.array(list(g.flat))
+        inverse = np.zeros(n)
+        inverse[nonzero] = 1.0 / dists[nonzero]
+        return np.dot(K, a)*np.sum(inverse) - np.dot(K, inverse)
 
     astar = fmin(f, a0, fprime=grad, disp=0)
     astar = np.asarray(astar)
@@ -211,28 +1150,64 @@ def median_weight(k, X):
     else:
         return astar
 
-def median_kernel(k):
+def weiszfeld(distances, a0, max_iter=1000, tol=1e-8):
     """
-    Makes a "median kernel" out of instance kernel k
+    Weiszfeld's algorithm for the geometric median: the
+    weights are repeatedly set proportional to the inverse
+    distances of the instances from the current median
     """
-    def make_weights(X):
+    a = a0
+    for _ in range(max_iter):
+        dists = distances(a)
+        if np.any(np.isnan(dists)):
+            # Clip round-off below zero
+            dists = np.nan_to_num(dists)
+        inverse = 1.0 / np.maximum(dists, 1e-12)
+        a_next = inverse / np.sum(inverse)
+        if np.sum(np.abs(a_next - a)) < tol:
+            return a_next
+        a = a_next
+    return a
+
+def _median_weight_job(args):
+    """Computes a median weight in a worker process"""
+    kernel_name, solver, x = args
+    k, _ = instance_kernel(kernel_name)
+    return median_weight(k, as_bag(x), solver)
+
+def weigher(k, kernel_name=None, n_jobs=1, solver='bfgs'):
+    """
+    Returns a function that computes the median weights
+    of a list of bags; if the name of k is given, the
+    weights are cached (by bag contents) across calls
+    and computed by n_jobs worker processes
+    """
+    def compute_weights(X):
+        if len(X) == 0:
+            return []
+        elif kernel_name is not None and pool_size(n_jobs) > 1:
+            jobs = [(kernel_name, solver, x) for x in X]
+            return parallel_map(_median_weight_job, jobs, n_jobs,
+                                processes=True)
         n = len(X)
         prog = ProgressMonitor(total=n, print_interval=1,
-                               msg='Constructing Kernel')
+                               msg='Computing Median Weights')
         ws = []
         for x in X:
             prog.increment()
-            ws.append(median_weight(k, x))
+            ws.append(median_weight(k, x, solver))
         return ws
 
-    def K(X, Y):
-        X_meds = make_weights(X)
-        if id(X) == id(Y):
-            Y_meds = X_meds
-        else:
-            Y_meds = make_weights(Y)
-        kernel = np.array([[float(np.dot(np.dot(a.T,k(x, y)),b))
-                            for y, b in zip(Y, Y_meds)]
-                           for x, a in zip(X, X_meds)])
-        return kernel
-    return K
+    def make_weights(X):
+        if kernel_name is None:
+            return compute_weights(X)
+        keys = [(kernel_name, solver, dense(x)) for x in X]
+        ws = map(WEIGHT_CACHE.lookup, keys)
+        missing = [i for i, w in enumerate(ws) if w is None]
+        computed = compute_weights([X[i] for i in missing])
+        for i, w in zip(missing, computed):
+            WEIGHT_CACHE.put(keys[i], w)
+            ws[i] = w
+        return ws
+
+    return make_weights